@@ -7,9 +7,16 @@ or from iOS notification actions.
 
 Harcoded custom logic for controlling HA with feedback from these actions.
 
+The presence of each person is kept as an incremental aggregate of their
+trackers, which first go through a flap damping filter (`TrackerDamper`:
+asymmetric hold times & a decaying penalty score). The args are documented
+in the README.
+
 """
 from datetime import datetime as dt
 from dateutil.parser import parse
+from math import log
+from time import monotonic
 
 import appdaemon.appapi as appapi
 import appdaemon.conf as conf
@@ -17,6 +24,61 @@ import appdaemon.conf as conf
 
 # DELAY_TO_SET_DEFAULT_TARGET = 1800  # sec
 DELAY_TO_SET_DEFAULT_TARGET = 120  # sec
+DEFAULT_HOLD_HOME = 2  # sec
+DEFAULT_HOLD_AWAY = 60  # sec
+DEFAULT_FLAP_HALF_LIFE = 900  # sec
+DEFAULT_FLAP_SUPPRESS = 3.
+DEFAULT_FLAP_REUSE = 1.5
+DEFAULT_FLAP_MAX_HOLD = 1800  # sec
+DEFAULT_FLAPS_SENSOR = 'sensor.family_tracker_flaps'
+
+
+def _is_home(state):
+    return (state == 'home') or (state == 'on')
+
+
+class TrackerDamper(object):
+    """Hysteresis & flap damping of the presence of a device tracker."""
+
+    def __init__(self, entity, state, hold_home, hold_away, half_life):
+        self.entity = entity
+        self.state = state  # accepted state
+        self.raw_state = state
+        self.hold_home = hold_home
+        self.hold_away = hold_away
+        self.half_life = half_life
+        self.penalty = 0.
+        self.penalty_ts = monotonic()
+        self.damped = False
+        self.timer = None
+        self.flaps_suppressed = 0
+        self.changes_accepted = 0
+
+    def __repr__(self):
+        return '<TrackerDamper {}: {} (raw={}), penalty={:.2f}{}>'.format(
+            self.entity, self.state, self.raw_state, self.current_penalty(),
+            ', DAMPED' if self.damped else '')
+
+    def current_penalty(self, now=None):
+        now = monotonic() if now is None else now
+        return self.penalty * .5 ** ((now - self.penalty_ts) / self.half_life)
+
+    def add_penalty(self, now):
+        self.penalty = self.current_penalty(now) + 1.
+        self.penalty_ts = now
+        return self.penalty
+
+    def hold_time(self, penalty, suppress, reuse, max_hold):
+        """Secs that the raw state has to hold to be accepted."""
+        hold = self.hold_home if _is_home(self.raw_state) else self.hold_away
+        if penalty >= suppress:
+            self.damped = True
+        elif penalty < reuse:
+            self.damped = False
+        if self.damped:
+            hold = max(hold, min(max_hold,
+                                 self.half_life * log(penalty / reuse, 2)))
+        return hold
 
 
 # noinspection PyClassHasNoInit
@@ -25,11 +87,21 @@ class FamilyTracker(appapi.AppDaemon):
 
     _tracking_state = None
     _telegram_targets = None
+    _people = None
+    _people_home = None
+    _last_out_dev = None
+    _current_target = None
     _notifier = None
     _timer_update_target = None
     _base_url = None
     _anybody_home = None
 
+    _dampers = None
+    _flap_suppress = None
+    _flap_reuse = None
+    _flap_max_hold = None
+    _flaps_sensor = None
+
     def initialize(self):
         """AppDaemon required method for app init."""
         config = dict(self.config['AppDaemon'])
@@ -46,6 +118,23 @@ class FamilyTracker(appapi.AppDaemon):
         self._telegram_targets = {"default": ('Casa', default_chat_id)}
 
         people_track = self.args.get('people', {})
+
+        # Flap damping:
+        hold_home = float(self.args.get('hold_home', DEFAULT_HOLD_HOME))
+        hold_away = float(self.args.get('hold_away', DEFAULT_HOLD_AWAY))
+        extra_hold_home = float(self.args.get('extra_hold_home', 0))
+        extra_hold_away = float(self.args.get('extra_hold_away', 0))
+        half_life = float(self.args.get(
+            'flap_half_life', DEFAULT_FLAP_HALF_LIFE))
+        self._flap_suppress = float(self.args.get(
+            'flap_suppress', DEFAULT_FLAP_SUPPRESS))
+        self._flap_reuse = float(self.args.get(
+            'flap_reuse', DEFAULT_FLAP_REUSE))
+        self._flap_max_hold = float(self.args.get(
+            'flap_max_hold', DEFAULT_FLAP_MAX_HOLD))
+        self._flaps_sensor = self.args.get(
+            'flaps_sensor', DEFAULT_FLAPS_SENSOR)
+        self._dampers = {}
         # self.log("people_track: {}".format(people_track))
 
         # Get devices to track:
@@ -61,10 +150,14 @@ class FamilyTracker(appapi.AppDaemon):
                            parse(self.get_state(dev, attribute='last_changed')
                                  ).astimezone(conf.tz)]
             self._tracking_state[dev] = tracking_st
+            person_args = people_track.get(dev, {})
+            self._dampers[dev] = TrackerDamper(
+                dev, tracking_st[0],
+                float(person_args.get('hold_home', hold_home)),
+                float(person_args.get('hold_away', hold_away)), half_life)
 
-            # Listen for state changes:
-            self.listen_state(self.track_zone_ch, dev, old="home", duration=60)
-            self.listen_state(self.track_zone_ch, dev, new="home", duration=2)
+            # Listen for state changes (through the flap damping):
+            self.listen_state(self._tracker_raw_change, dev)
 
             # Get details for each device/group:
             if dev in people_track:
@@ -80,11 +173,23 @@ class FamilyTracker(appapi.AppDaemon):
                               ).astimezone(conf.tz)]
                     self._telegram_targets[dev_extra] = (name, target)
                     self._tracking_state[dev_extra] = extra_tracking_st
-                    self.listen_state(self.track_zone_ch, dev_extra)
+                    self._dampers[dev_extra] = TrackerDamper(
+                        dev_extra, extra_tracking_st[0],
+                        float(people_track[dev].get(
+                            'hold_home', extra_hold_home)),
+                        float(people_track[dev].get(
+                            'hold_away', extra_hold_away)), half_life)
+                    self.listen_state(self._tracker_raw_change, dev_extra)
             self._telegram_targets[dev] = (name, target)
 
+        # Presence aggregates per person:
+        self._people, self._people_home = {}, set()
+        for dev, (st, last_ch) in self._tracking_state.items():
+            self._update_person(dev, st, last_ch)
+
         # Process (and write globals) who is at home
         self._who_is_at_home(False)
+        self._publish_flaps()
 
     def _make_notifications(self, exiting_home, telegram_target):
         if exiting_home:
@@ -120,43 +225,60 @@ class FamilyTracker(appapi.AppDaemon):
         }
         return data_ios, data_telegram
 
+    def _update_person(self, dev, st, last_ch):
+        """Update the presence of the person of a device with its new state.
+
+        The most recent change of any of their devices sets the presence of
+        the person; returns True if it changes."""
+        person, _target = self._telegram_targets[dev]
+        at_home = _is_home(st)
+        if person in self._people and last_ch <= self._people[person][1]:
+            return False
+        was_home = person in self._people_home
+        self._people[person] = at_home, last_ch, dev
+        if at_home:
+            self._people_home.add(person)
+        else:
+            self._people_home.discard(person)
+            if was_home:
+                self._last_out_dev = dev
+        return at_home != was_home
+
+    # noinspection PyUnusedLocal
+    def _reset_target(self, kwargs):
+        self._timer_update_target = None
+        self._who_is_at_home(False)
+
     def _who_is_at_home(self, zone_changed):
         if self._timer_update_target is not None:
             self.cancel_timer(self._timer_update_target)
             self._timer_update_target = None
 
-        people, new_target = {}, None
-        for dev, (st, last_ch) in self._tracking_state.items():
-            at_home = (st == 'home') or (st == 'on')
-            person, target = self._telegram_targets[dev]
-            if person not in people:
-                people[person] = at_home, last_ch, dev
-                if at_home:
-                    new_target = target
-            elif last_ch > people[person][1]:
-                people[person] = at_home, last_ch, dev
-
         # Set default chat_id and people_home
-        people_home = {k: v for k, v in people.items() if v[0]}
-        new_anybody_home = len(people_home) > 0
-        if not new_anybody_home and zone_changed:
+        new_anybody_home = len(self._people_home) > 0
+        if not new_anybody_home and zone_changed \
+                and self._last_out_dev is not None:
             # Set last person exiting the house (at least for some time)
-            last_dev = list(sorted(people.values(), key=lambda x: x[2]))[-1][2]
-            _last_person, new_target = self._telegram_targets[last_dev]
+            _last_person, new_target = self._telegram_targets[
+                self._last_out_dev]
             self._timer_update_target = self.run_in(
-                self._who_is_at_home, DELAY_TO_SET_DEFAULT_TARGET,
-                zone_changed=False)
-        elif not new_anybody_home or len(people_home) > 1:
+                self._reset_target, DELAY_TO_SET_DEFAULT_TARGET)
+        elif not new_anybody_home or len(self._people_home) > 1:
             new_target = self._telegram_targets["default"][1]
         else:
+            person_home = next(iter(self._people_home))
+            _person, new_target = self._telegram_targets[
+                self._people[person_home][2]]
             self.log("WHO IS AT HOME? people: {}, zone_changed:{}, target:{}"
-                       .format(people, zone_changed, new_target))
+                     .format(self._people, zone_changed, new_target))
 
         if new_target is None:
             return
 
-        self.call_service(
-            'python_script/set_telegram_chatid_sensor', chat_id=new_target)
+        if new_target != self._current_target:
+            self.call_service(
+                'python_script/set_telegram_chatid_sensor', chat_id=new_target)
+            self._current_target = new_target
 
         # Todo entradas - salidas de personas individuales
         if new_anybody_home != self._anybody_home:
@@ -169,14 +291,76 @@ class FamilyTracker(appapi.AppDaemon):
                               **data_telegram)
             self._anybody_home = new_anybody_home
 
+    def _publish_flaps(self):
+        """Set the flap counters of the trackers as a sensor."""
+        now = monotonic()
+        attributes = {'friendly_name': 'Family tracker flaps',
+                      'icon': 'mdi:swap-horizontal'}
+        for dev, damper in self._dampers.items():
+            object_id = dev.split('.')[1]
+            attributes[object_id + '_suppressed'] = damper.flaps_suppressed
+            attributes[object_id + '_accepted'] = damper.changes_accepted
+            attributes[object_id + '_penalty'] = round(
+                damper.current_penalty(now), 2)
+            attributes[object_id + '_damped'] = damper.damped
+        self.set_state(self._flaps_sensor, attributes=attributes,
+                       state=sum(damper.flaps_suppressed
+                                 for damper in self._dampers.values()))
+
+    # noinspection PyUnusedLocal
+    def _tracker_raw_change(self, entity, attribute, old, new, kwargs):
+        """Flap damping of the tracker changes, before `track_zone_ch`."""
+        damper = self._dampers[entity]
+        damper.raw_state = new
+        if _is_home(new) == _is_home(damper.state):
+            if damper.timer is not None:
+                # Back to the accepted presence before the hold time: flap
+                self.cancel_timer(damper.timer)
+                damper.timer = None
+                damper.flaps_suppressed += 1
+                self.log('SUPPRESSED FLAP {}'.format(damper))
+                self._publish_flaps()
+            elif new != damper.state:
+                # Change of zone without presence change
+                self._accept_tracker_state(damper)
+            return
+
+        if damper.timer is not None:
+            # Already waiting for this presence change
+            return
+        penalty = damper.add_penalty(monotonic())
+        hold = damper.hold_time(
+            penalty, self._flap_suppress, self._flap_reuse,
+            self._flap_max_hold)
+        if hold > 0:
+            damper.timer = self.run_in(
+                self._tracker_hold_expired, hold, entity=entity)
+        else:
+            self._accept_tracker_state(damper)
+
+    def _tracker_hold_expired(self, kwargs):
+        damper = self._dampers[kwargs['entity']]
+        damper.timer = None
+        if _is_home(damper.raw_state) != _is_home(damper.state):
+            self._accept_tracker_state(damper)
+
+    def _accept_tracker_state(self, damper):
+        old, damper.state = damper.state, damper.raw_state
+        if _is_home(old) != _is_home(damper.state):
+            damper.changes_accepted += 1
+            self._publish_flaps()
+        self.track_zone_ch(damper.entity, 'state', old, damper.state, {})
+
     # noinspection PyUnusedLocal
     def track_zone_ch(self, entity, attribute, old, new, kwargs):
-        """State change listener."""
+        """State change listener (for the accepted tracker changes)."""
         last_st, last_ch = self._tracking_state[entity]
-        self._tracking_state[entity] = [new, dt.now(tz=conf.tz)]
+        now = dt.now(tz=conf.tz)
+        self._tracking_state[entity] = [new, now]
 
         # Process changes
-        self._who_is_at_home(True)
+        if self._update_person(entity, new, now):
+            self._who_is_at_home(True)
 
         if last_st != old:
             self.log('!!BAD TRACKING_STATE_CHANGE "{}" from "{}" [!="{}"'
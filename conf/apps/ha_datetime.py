@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+Home Assistant timestamps for AppDaemon Apps for Home Assistant
+
+Helpers without state (no AppDaemon or engine objects are created on import), shared by the apps:
+
+    ts = parse_ha_datetime(new['last_changed'])
+
+"""
+import datetime as dt
+from dateutil.parser import parse
+
+
+def parse_ha_datetime(value):
+    """Parse a HA timestamp, with a fast path for its fixed ISO-8601 format.
+
+    '2017-06-01T10:20:30.123456+00:00' or '2017-06-01T10:20:30+02:00' are parsed by slicing; anything else
+    goes through `dateutil.parser.parse`."""
+    if value is None:
+        return None
+    try:
+        if value[10] == 'T' and value[-3] == ':' and value[-6] in '+-':
+            if len(value) == 32 and value[19] == '.':
+                micro = int(value[20:26])
+            elif len(value) == 25:
+                micro = 0
+            else:
+                raise ValueError
+            offset = int(value[-5:-3]) * 60 + int(value[-2:])
+            if offset:
+                offset = dt.timedelta(minutes=offset if value[-6] == '+' else -offset)
+                tz = dt.timezone(offset)
+            else:
+                tz = dt.timezone.utc
+            return dt.datetime(int(value[:4]), int(value[5:7]), int(value[8:10]), int(value[11:13]),
+                               int(value[14:16]), int(value[17:19]), micro, tz)
+    except (IndexError, TypeError, ValueError):
+        pass
+    return parse(value)
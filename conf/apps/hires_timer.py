@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+High resolution timers for AppDaemon Apps for Home Assistant
+
+The AppDaemon scheduler ticks once per second, so `run_in` / `run_every` can't be used for sub-second deadlines.
+This module runs one daemon thread with a min-heap of deadlines (monotonic clock), shared by all the apps:
+
+    handle = TIMER.call_later(.5, self._my_callback, arg1)
+    TIMER.reschedule(handle, monotonic() + 2)  # move the same timer (or re-arm it if it has already fired)
+    TIMER.cancel(handle)
+
+Callbacks run in the timer thread, so they must be short (or hand the work off to other threads). Their errors are
+reported with the `log` callable of the timer (as `log(msg, level)`, like `self.log` of the apps):
+
+    handle = TIMER.call_later(.5, self._my_callback, arg1, log=self.log)
+
+"""
+import heapq
+from itertools import count
+from threading import Condition, Thread
+from time import monotonic
+import traceback
+
+
+class TimerHandle(object):
+    """Resettable timer returned by `HighResTimer.call_at`."""
+
+    __slots__ = ('deadline', 'callback', 'args', 'log', 'pending')
+
+    def __init__(self, deadline, callback, args, log=None):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.log = log
+        self.pending = True
+
+
+class HighResTimer(object):
+    """Timer thread with a min-heap of deadlines.
+
+    Rescheduled timers leave their old heap entries behind, which are discarded when they pop."""
+
+    def __init__(self, name='hires_timer'):
+        self._name = name
+        self._cond = Condition()
+        self._heap = []
+        self._seq = count()
+        self._thread = None
+
+    def call_at(self, deadline, callback, *args, log=None):
+        """Run `callback(*args)` at the `deadline` (in `time.monotonic()` seconds); errors go to `log(msg, level)`."""
+        handle = TimerHandle(deadline, callback, args, log)
+        self._push(handle)
+        return handle
+
+    def call_later(self, delay, callback, *args, log=None):
+        """Run `callback(*args)` after `delay` seconds."""
+        return self.call_at(monotonic() + delay, callback, *args, log=log)
+
+    def reschedule(self, handle, deadline):
+        """Move a timer to a new deadline, re-arming it if it was cancelled or has already fired."""
+        with self._cond:
+            handle.deadline = deadline
+            handle.pending = True
+            self._push(handle)
+
+    def cancel(self, handle):
+        """Cancel a pending timer."""
+        handle.pending = False
+
+    def _push(self, handle):
+        with self._cond:
+            heapq.heappush(self._heap, (handle.deadline, next(self._seq), handle))
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name=self._name, daemon=True)
+                self._thread.start()
+            elif self._heap[0][2] is handle:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    deadline, _, handle = self._heap[0]
+                    if not handle.pending or deadline != handle.deadline:
+                        # Cancelled or rescheduled
+                        heapq.heappop(self._heap)
+                        continue
+                    delay = deadline - monotonic()
+                    if delay > 0:
+                        self._cond.wait(delay)
+                        continue
+                    heapq.heappop(self._heap)
+                    handle.pending = False
+                    break
+            try:
+                handle.callback(*handle.args)
+            except Exception:
+                msg = 'Error in timer callback {}:\n{}'.format(handle.callback, traceback.format_exc())
+                if handle.log is None:
+                    print(msg)
+                else:
+                    handle.log(msg, 'ERROR')
+
+
+TIMER = HighResTimer()
@@ -5,6 +5,9 @@ Automation task as a AppDaemon App for Home Assistant
 This little app controls the ambient light when Kodi plays video,
 dimming some lights and turning off others, and returning to the
 initial state when the playback is finished.
+The light states are mirrored in memory (`lights_mirror.LightsMirror`), and
+the light commands are sent through it, grouped in one call per target and
+skipping the lights that are already there.
 
 In addition, it also sends notifications when starting the video playback,
 reporting the video info in the message.
@@ -17,6 +20,7 @@ import appdaemon.appapi as appapi
 import appdaemon.utils as utils
 from homeassistant.components.media_player.kodi import (
     EVENT_KODI_CALL_METHOD_RESULT)
+from lights_mirror import LightsMirror
 
 
 LOG_LEVEL = 'DEBUG'
@@ -60,6 +64,7 @@ class KodiAssistant(appapi.AppDaemon):
 
     _lights = None
     _light_states = {}
+    _mirror = None
 
     _media_player = None
     _is_playing_video = False
@@ -74,13 +79,20 @@ class KodiAssistant(appapi.AppDaemon):
         """AppDaemon required method for app init."""
         conf_data = dict(self.config['AppDaemon'])
 
-        _lights_dim_on = self.args.get('lights_dim_on', '').split(',')
-        _lights_dim_off = self.args.get('lights_dim_off', '').split(',')
-        _lights_off = self.args.get('lights_off', '').split(',')
+        _lights_dim_on = [l for l in self.args.get(
+            'lights_dim_on', '').split(',') if l]
+        _lights_dim_off = [l for l in self.args.get(
+            'lights_dim_off', '').split(',') if l]
+        _lights_off = [l for l in self.args.get(
+            'lights_off', '').split(',') if l]
         _switch_dim_group = self.args.get('switch_dim_lights_use')
         self._lights = {"dim": {"on": _lights_dim_on, "off": _lights_dim_off},
                         "off": _lights_off,
                         "state": self.get_state(_switch_dim_group)}
+        self._mirror = LightsMirror(self)
+        self._mirror.add_group('dim_on', _lights_dim_on)
+        self._mirror.add_group('dim_off', _lights_dim_off)
+        self._mirror.add_group('off', _lights_off)
         # Listen for ambilight changes to change light dim group:
         self.listen_state(self.ch_dim_lights_group, _switch_dim_group)
 
@@ -217,46 +229,43 @@ class KodiAssistant(appapi.AppDaemon):
 
     def _adjust_kodi_lights(self, play=True):
         k_l = self._lights['dim'][self._lights['state']] + self._lights['off']
-        for light_id in k_l:
-            if play:
-                light_state = self.get_state(light_id)
-                attrs_light = self.get_state(light_id, attribute='attributes')
-                attrs_light.update({"state": light_state})
+        if play:
+            max_brightness = _get_max_brightness_ambient_lights()
+            to_dim = []
+            for light_id in k_l:
+                attrs_light = dict(self._mirror.attributes(light_id))
+                attrs_light.update({"state": self._mirror.state(light_id)})
                 self._light_states[light_id] = attrs_light
-                max_brightness = _get_max_brightness_ambient_lights()
-                if light_id in self._lights['off']:
-                    self.log('Apagando light {} para KODI PLAY'
-                             .format(light_id), LOG_LEVEL)
-                    self.call_service(
-                        "light/turn_off", entity_id=light_id, transition=2)
-                elif ("brightness" in attrs_light.keys()
-                      ) and (attrs_light["brightness"] > max_brightness):
-                    self.log('Atenuando light {} para KODI PLAY'
-                             .format(light_id), LOG_LEVEL)
-                    self.call_service("light/turn_on", entity_id=light_id,
-                                      transition=2, brightness=max_brightness)
-            else:
-                try:
-                    state_before = self._light_states[light_id]
-                except KeyError:
-                    state_before = {}
-                if ('state' in state_before) \
-                        and (state_before['state'] == 'on'):
-                    try:
+                if light_id not in self._lights['off'] \
+                        and attrs_light.get("brightness", 0) > max_brightness:
+                    to_dim.append(light_id)
+            turned_off = self._mirror.turn_off(self._lights['off'],
+                                               transition=2)
+            dimmed = self._mirror.turn_on(to_dim, transition=2,
+                                          brightness=max_brightness)
+            self.log('KODI PLAY: apagando lights {}, atenuando lights {}'
+                     .format(turned_off, dimmed), LOG_LEVEL)
+        else:
+            targets = {}
+            for light_id in k_l:
+                state_before = self._light_states.get(light_id, {})
+                if state_before.get('state') == 'on':
+                    if "xy_color" in state_before:
                         new_state_attrs = {
                             "xy_color": state_before["xy_color"],
                             "brightness": state_before["brightness"]}
-                    except KeyError:
+                    else:
                         new_state_attrs = {
                             "color_temp": state_before["color_temp"],
                             "brightness": state_before["brightness"]}
-                    self.log('Reponiendo light {}, con state_before={}'
-                             .format(light_id, state_before), LOG_LEVEL)
-                    self.call_service("light/turn_on", entity_id=light_id,
-                                      transition=2, **new_state_attrs)
+                    targets[light_id] = ('on', new_state_attrs)
                 else:
                     self.log('Doing nothing with light {}, state_before={}'
                              .format(light_id, state_before), LOG_LEVEL)
+            restored = self._mirror.apply(targets, transition=2)
+            self.log('KODI STOP: reponiendo lights {} (sin cambios: {})'
+                     .format(restored, [l for l in targets
+                                        if l not in restored]), LOG_LEVEL)
 
     # noinspection PyUnusedLocal
     def kodi_state(self, entity, attribute, old, new, kwargs):
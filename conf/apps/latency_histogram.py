@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Latency histogram for AppDaemon Apps for Home Assistant
+
+Fixed, log-spaced buckets (each one 25% wider than the previous, from 0.5 ms to ~18 s), so adding a sample is
+one bisect and the memory doesn't grow with the number of samples. Percentiles are interpolated inside the bucket:
+
+    latency = LatencyHistogram()
+    latency.add(0.0123)  # seconds
+    latency.summary()  # {'count': 1, 'mean_ms': 12.3, 'p50_ms': ..., 'p95_ms': ..., 'p99_ms': ..., 'max_ms': 12.3}
+
+"""
+from bisect import bisect_left
+from threading import Lock
+
+
+BUCKET_BOUNDS_MS = tuple(round(.5 * 1.25 ** i, 3) for i in range(48))
+
+
+class LatencyHistogram(object):
+    """Thread safe latency histogram with fixed buckets."""
+
+    def __init__(self, bounds_ms=BUCKET_BOUNDS_MS):
+        self._bounds = tuple(bounds_ms)
+        self._lock = Lock()
+        self._counts = None
+        self._count = self._total_ms = self._max_ms = None
+        self.reset()
+
+    def __len__(self):
+        return self._count
+
+    def add(self, seconds):
+        """Add a sample, in seconds."""
+        value_ms = seconds * 1000.
+        idx = bisect_left(self._bounds, value_ms)
+        with self._lock:
+            self._counts[idx] += 1
+            self._count += 1
+            self._total_ms += value_ms
+            if value_ms > self._max_ms:
+                self._max_ms = value_ms
+
+    def reset(self):
+        with self._lock:
+            self._counts = [0] * (len(self._bounds) + 1)
+            self._count = 0
+            self._total_ms = 0.
+            self._max_ms = 0.
+
+    def percentile(self, pct):
+        """Estimated percentile (0-100) in ms (0 if there are no samples)."""
+        with self._lock:
+            return self._percentile(self._counts, self._count, self._max_ms, pct)
+
+    def summary(self, reset=False):
+        """Count, mean, p50, p95, p99 & max of the samples (in ms); with `reset`, the histogram starts again."""
+        with self._lock:
+            counts, count, total_ms, max_ms = self._counts, self._count, self._total_ms, self._max_ms
+            if reset:
+                self._counts = [0] * (len(self._bounds) + 1)
+                self._count = 0
+                self._total_ms = 0.
+                self._max_ms = 0.
+        summary = {'count': count, 'mean_ms': round(total_ms / count, 2) if count else 0.}
+        for pct in (50, 95, 99):
+            summary['p{}_ms'.format(pct)] = round(self._percentile(counts, count, max_ms, pct), 2)
+        summary['max_ms'] = round(max_ms, 2)
+        return summary
+
+    def _percentile(self, counts, count, max_ms, pct):
+        if not count:
+            return 0.
+        rank = count * pct / 100.
+        accum = 0
+        for idx, num in enumerate(counts):
+            if num and accum + num >= rank:
+                lower = self._bounds[idx - 1] if idx else 0.
+                upper = self._bounds[idx] if idx < len(self._bounds) else max_ms
+                return min(max_ms, lower + (upper - lower) * (rank - accum) / num)
+            accum += num
+        return max_ms
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory mirror of light states for AppDaemon Apps for Home Assistant
+
+Each light is read once, and then kept up to date by one `listen_state(attribute='all')` callback, so the apps can
+check the state & attributes of their lights without `get_state` calls in their hot paths. Lights are arranged in
+named groups, with a counter of the lights 'on' in each group, so 'is any light of this group on?' is O(1):
+
+    self._mirror = LightsMirror(self, on_change=self._light_changed)
+    self._mirror.add_group('motion', ['light.bola_grande', 'light.cuenco'])
+    if not self._mirror.any_on('motion'):
+        ...
+
+`on_change(entity, old_state, new_state)` is called (in the AppDaemon callback thread) when a light changes its state.
+
+The mirror callbacks are registered with the host app, so its AppDaemon constraints (`constrain_*` args) gate them
+too: apps with constraints have to `resync()` the mirror (one `get_state` per domain) before trusting it.
+
+The light commands can go through the mirror too, which drops the redundant ones (lights already in the requested
+state, with the requested attributes, or already commanded to it and still waiting for its state change), and sends
+the rest as one service call with an `entity_id` list for each distinct target:
+
+    self._mirror.turn_on(['light.bola_grande', 'light.cuenco'], transition=0, color_temp=300, brightness=200)
+    self._mirror.turn_off(['light.bola_grande', 'light.cuenco'], transition=1)
+    self._mirror.apply({'light.salon': ('on', {'brightness': 150}), 'light.tv': ('off', {})}, transition=2)
+
+Attributes not reported by the light (like `flash` or `brightness_pct`) can't be checked, so they are always sent.
+
+"""
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+STATE_ON = 'on'
+STATE_OFF = 'off'
+# Max. difference between the requested & reported values to consider the light at target (HA / Hue rounding)
+ATTR_TOLERANCE = {'brightness': 1, 'color_temp': 1, 'xy_color': .002, 'hs_color': .5, 'rgb_color': 1}
+# Max. time (secs) to wait for the state change of a command before sending it again
+PENDING_TTL = 3.
+
+
+def _same_value(current, wanted, tolerance):
+    if current is None:
+        return False
+    if tolerance is None:
+        return current == wanted
+    try:
+        if isinstance(wanted, (list, tuple)):
+            return len(current) == len(wanted) and all(abs(c - w) <= tolerance for c, w in zip(current, wanted))
+        return abs(current - wanted) <= tolerance
+    except TypeError:
+        return current == wanted
+
+
+class LightsMirror(object):
+    """State & attributes of a set of lights, updated by AppDaemon state callbacks."""
+
+    def __init__(self, app, on_change=None):
+        self._app = app
+        self._on_change = on_change
+        self._lock = Lock()
+        self._states = {}
+        self._attributes = {}
+        self._groups = {}
+        self._num_on = {}
+        self._groups_of = {}
+        self._handles = {}
+        self._pending = {}
+        self.commands_sent = 0
+        self.commands_skipped = 0
+
+    def __repr__(self):
+        return '<LightsMirror {}>'.format(self._states)
+
+    def add_group(self, group, lights):
+        """Mirror (if not already done) a group of lights."""
+        for light in lights:
+            if light not in self._states:
+                self._track(light)
+        with self._lock:
+            self._groups[group] = tuple(lights)
+            self._num_on[group] = sum(self._states[light] == STATE_ON for light in lights)
+            for light in lights:
+                self._groups_of.setdefault(light, []).append(group)
+
+    def state(self, light):
+        """Mirrored state of a light (None if it doesn't exist)."""
+        return self._states.get(light)
+
+    def attributes(self, light):
+        """Mirrored attributes of a light."""
+        return self._attributes.get(light, {})
+
+    def is_on(self, light):
+        return self._states.get(light) == STATE_ON
+
+    def in_group(self, light, group):
+        return group in self._groups_of.get(light, ())
+
+    def any_on(self, group):
+        """Some light of the group is on."""
+        return self._num_on[group] > 0
+
+    def all_on(self, group):
+        """All the lights of the group are on."""
+        return self._num_on[group] == len(self._groups[group])
+
+    def group_states(self, group):
+        """Mirrored states of the lights of a group, as a dict."""
+        return {light: self._states[light] for light in self._groups[group]}
+
+    def turn_on(self, lights, transition=None, **target):
+        """`light/turn_on` the lights not already on with the `target` attributes; returns the lights commanded."""
+        return self._command(STATE_ON, lights, target, transition)
+
+    def turn_off(self, lights, transition=None):
+        """`light/turn_off` the lights not already off; returns the lights commanded."""
+        return self._command(STATE_OFF, lights, {}, transition)
+
+    def apply(self, targets, transition=None):
+        """Set the lights to their targets (`{light: (state, attributes)}`), with one call for each distinct target;
+        returns the lights commanded."""
+        by_target = OrderedDict()
+        for light, (state, attributes) in targets.items():
+            key = (state, tuple(sorted((attr, tuple(value) if isinstance(value, list) else value)
+                                       for attr, value in attributes.items())))
+            by_target.setdefault(key, (state, attributes, []))[2].append(light)
+        commanded = []
+        for state, attributes, lights in by_target.values():
+            commanded += self._command(state, lights, attributes if state == STATE_ON else {}, transition)
+        return commanded
+
+    def _at_target(self, light, state, target, now):
+        pending = self._pending.get(light)
+        if pending is not None and now - pending[2] < PENDING_TTL and pending[:2] == (state, target):
+            return True
+        if self._states.get(light) != state:
+            return False
+        if state != STATE_ON:
+            return True
+        attributes = self._attributes.get(light, {})
+        return all(_same_value(attributes.get(attr), value, ATTR_TOLERANCE.get(attr))
+                   for attr, value in target.items())
+
+    def _command(self, state, lights, target, transition):
+        now = monotonic()
+        with self._lock:
+            to_send = [light for light in lights if not self._at_target(light, state, target, now)]
+            for light in to_send:
+                self._pending[light] = (state, target, now)
+            self.commands_skipped += len(lights) - len(to_send)
+            if to_send:
+                self.commands_sent += 1
+        if to_send:
+            data = dict(target)
+            if transition is not None:
+                data['transition'] = transition
+            self._app.call_service('light/turn_{}'.format(state), entity_id=to_send, **data)
+        return to_send
+
+    def resync(self):
+        """Refresh the mirrored lights from one states snapshot per domain, as the missed state callbacks would do."""
+        states = {}
+        for domain in set(light.split('.')[0] for light in self._states):
+            states.update(self._app.get_state(domain) or {})
+        for light in list(self._states):
+            new = states.get(light)
+            if new is None and self._states[light] is None:
+                continue
+            if new is not None and new['state'] == self._states[light] \
+                    and new['attributes'] == self._attributes[light]:
+                continue
+            self._light_changed(light, 'all', None, new, {})
+
+    def _track(self, light):
+        state_atts = self._app.get_state(light, attribute='all')
+        self._states[light] = state_atts['state'] if state_atts else None
+        self._attributes[light] = dict(state_atts['attributes']) if state_atts else {}
+        self._handles[light] = self._app.listen_state(self._light_changed, light, attribute='all')
+
+    # noinspection PyUnusedLocal
+    def _light_changed(self, entity, attribute, old, new, kwargs):
+        new_state = new['state'] if new else None
+        with self._lock:
+            old_state = self._states.get(entity)
+            self._states[entity] = new_state
+            self._attributes[entity] = new['attributes'] if new else {}
+            self._pending.pop(entity, None)
+            if (old_state == STATE_ON) != (new_state == STATE_ON):
+                delta = 1 if new_state == STATE_ON else -1
+                for group in self._groups_of.get(entity, ()):
+                    self._num_on[group] += delta
+        if self._on_change is not None and old_state != new_state:
+            self._on_change(entity, old_state, new_state)
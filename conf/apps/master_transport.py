@@ -0,0 +1,525 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP transport for posting states from a 'slave' HASS instance in a 'master' HASS instance
+
+Replaces the `homeassistant.remote.set_state` calls (a new HTTP connection per request, made from the AppDaemon
+callback threads) with a persistent `requests.Session` (keep-alive, connection pool) and a small pool of worker
+threads, which bounds the number of requests in flight:
+
+    transport = MasterTransport('192.168.1.10', 'api_password', port=8123, max_in_flight=4, log=self.log)
+    transport.set_state('sensor.temperature_slave', '21.5', {'unit_of_measurement': '°C'})  # returns at once
+    ...
+    transport.stop()
+
+`set_state` writes into a keyed buffer (entity -> last state & attributes) which is drained every
+`flush_interval` seconds, so an entity updated 5 times between flushes produces only one request.
+`stats()` reports the coalescing ratio and the queue depths, for tuning that interval, and the request counters
+(requests, failures, retries, states & bytes sent) with a histogram of the request latencies.
+
+The content hash (`state_hash`) of the last state acknowledged by the master for each entity is kept
+(`acked_hash(entity_id)`), so callers can skip resending values the master already has.
+
+When the master is unreachable (connection errors, timeouts or 5xx responses), the transport goes offline and
+the undelivered states go to an `OutboundSpool` (a sqlite table in WAL mode, one row per entity, so it is already
+compacted to the last value per entity) instead of being lost. While offline, the master API is probed every
+`probe_interval` seconds; when it answers, the spool is replayed at `replay_rate` states/sec, so a master which is
+still starting up doesn't get the whole burst at once. New states keep going through the spool until it is empty,
+so a replayed (old) value never overwrites a newer one.
+
+With a `batch_event`, the states are not set one by one (`POST /api/states/<entity_id>`, one request per entity)
+but sent in batches of up to `batch_size` states as the data of a custom event (`POST /api/events/<batch_event>`),
+which a receiver app in the master applies (`apply_batch_event`, used by `SlaveStatesReceiver`). In batches,
+the attributes of an entity are only sent when they change (their hash differs from the last ones acknowledged
+by the master); the receiver keeps the current attributes of the states which come without them.
+
+The 200 answer to a posted event only means that the master has fired it, not that the receiver has applied it, so
+the batches are numbered (by worker, in a random session of the transport) and the receiver confirms them in an ack
+entity of the master (`batch_ack_entity`: its state is the session, and each attribute the last sequence number
+applied of a worker, as `batch_ack_state` makes it). The transport reads it every `batch_ack_interval` seconds
+(while there are batches to confirm), and only the confirmed states count as acknowledged: with no receiver, the
+states are always sent with their attributes.
+
+"""
+from collections import deque, OrderedDict
+import json
+from queue import Queue
+import sqlite3
+from threading import Event, Lock, Thread
+from time import monotonic, time
+import traceback
+import uuid
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from latency_histogram import LatencyHistogram
+
+
+DEFAULT_PORT = 8123
+DEFAULT_MAX_IN_FLIGHT = 4
+DEFAULT_TIMEOUT = 5
+DEFAULT_FLUSH_INTERVAL = 1.
+DEFAULT_PROBE_INTERVAL = 10.
+DEFAULT_REPLAY_RATE = 20.
+DEFAULT_BATCH_EVENT = 'slave_states'
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_BATCH_ACK_INTERVAL = 5.
+BATCH_ACK_ATTRIBUTE = 'seq_{}'
+MAX_UNCONFIRMED_BATCHES = 1000
+HEADER_HA_ACCESS = 'X-HA-access'
+
+
+def attributes_hash(attributes):
+    """Content hash of the attributes of a state."""
+    return hash(json.dumps(attributes or {}, sort_keys=True, default=str))
+
+
+def state_hash(state, attributes=None):
+    """Content hash of a state & its attributes."""
+    return hash((str(state), attributes_hash(attributes)))
+
+
+def master_base_url(host, port=DEFAULT_PORT, use_ssl=False):
+    """Base URL of the HA API, as `homeassistant.remote.API` makes it."""
+    if host.startswith(('http://', 'https://')):
+        base_url = host
+    elif use_ssl:
+        base_url = 'https://{}'.format(host)
+    else:
+        base_url = 'http://{}'.format(host)
+    if port is not None:
+        base_url += ':{}'.format(port)
+    return base_url
+
+
+def batch_event_data(items, ack=None):
+    """Event data of a batch of (entity_id, state, attributes) states (`attributes=None` to leave them as they are).
+
+    `ack` ({'entity_id', 'session', 'worker', 'seq'}) asks the receiver to confirm the batch."""
+    states = []
+    for entity_id, state, attributes in items:
+        item = {'entity_id': entity_id, 'state': state}
+        if attributes is not None:
+            item['attributes'] = attributes
+        states.append(item)
+    data = {'states': states}
+    if ack is not None:
+        data['ack'] = ack
+    return data
+
+
+def apply_batch_event(data, set_state):
+    """Apply the states of a batch event with `set_state(entity_id, state, attributes)`, with `attributes=None` for
+    the states sent without attributes (unchanged). Returns the number of states."""
+    states = data.get('states') or []
+    for item in states:
+        set_state(item['entity_id'], item['state'], item.get('attributes'))
+    return len(states)
+
+
+def batch_ack_state(ack, current=None):
+    """State & attributes of the ack entity after applying a batch with `ack`, from its `current` state (a HA state
+    dict, or None). A new session of the transport starts from scratch."""
+    attributes = {}
+    if current is not None and current.get('state') == ack['session']:
+        attributes.update(current.get('attributes') or {})
+    key = BATCH_ACK_ATTRIBUTE.format(ack['worker'])
+    attributes[key] = max(ack['seq'], attributes.get(key, 0))
+    return ack['session'], attributes
+
+
+class OutboundSpool(object):
+    """On-disk spool of the states not delivered to the master, compacted to the last value per entity.
+
+    A sqlite table keyed by entity (WAL journal, so the writes don't block the readers). `path=':memory:'`
+    keeps it in RAM (lost on restart)."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS spool (entity_id TEXT PRIMARY KEY, state TEXT, '
+                           'attributes TEXT, ts REAL)')
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM spool').fetchone()[0]
+
+    def put(self, entity_id, state, attributes, ts):
+        """Spool a state (set at `ts`), unless a newer state of the entity is already spooled."""
+        with self._lock:
+            row = self._conn.execute('SELECT ts FROM spool WHERE entity_id = ?', (entity_id,)).fetchone()
+            if row is None or row[0] <= ts:
+                self._conn.execute('INSERT OR REPLACE INTO spool VALUES (?, ?, ?, ?)',
+                                   (entity_id, state, json.dumps(attributes or {}, default=str), ts))
+
+    def pop(self, limit):
+        """Take the `limit` oldest spooled states, as a list of (entity_id, state, attributes, ts)."""
+        with self._lock:
+            rows = self._conn.execute('SELECT entity_id, state, attributes, ts FROM spool ORDER BY ts LIMIT ?',
+                                      (limit,)).fetchall()
+            self._conn.executemany('DELETE FROM spool WHERE entity_id = ? AND ts = ?',
+                                   [(row[0], row[3]) for row in rows])
+        return [(entity_id, state, json.loads(attributes), ts) for entity_id, state, attributes, ts in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class MasterTransport(object):
+    """Keep-alive, connection-pooled transport for setting states in a master HA.
+
+    `set_state` only queues the request: `max_in_flight` worker threads post them through the shared session,
+    so slow POSTs never pin the AppDaemon callback threads. Each entity always goes to the same worker queue,
+    so the updates of one entity reach the master in order.
+
+    With `flush_interval` > 0, states are buffered (last value wins) and a flusher thread hands them
+    to the workers periodically.
+
+    With a `spool_path`, the states which can't be delivered are spooled there during master outages,
+    and replayed (at `replay_rate` states/sec) when the master is back.
+
+    With a `batch_event`, each worker posts its states in batches (events of up to `batch_size` states), which
+    the receiver confirms in the `batch_ack_entity` of the master (by default, `sensor.<batch_event>_ack`)."""
+
+    def __init__(self, host, api_key='', port=DEFAULT_PORT, use_ssl=False,
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT, timeout=DEFAULT_TIMEOUT,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, spool_path=None,
+                 probe_interval=DEFAULT_PROBE_INTERVAL, replay_rate=DEFAULT_REPLAY_RATE,
+                 batch_event=None, batch_size=DEFAULT_BATCH_SIZE, batch_ack_entity=None,
+                 batch_ack_interval=DEFAULT_BATCH_ACK_INTERVAL, log=None):
+        self.base_url = master_base_url(host, port, use_ssl)
+        self._timeout = timeout
+        self._batch_event = batch_event
+        self._batch_size = max(1, batch_size)
+        self._batch_ack_entity = batch_ack_entity or 'sensor.{}_ack'.format(batch_event)
+        self._batch_ack_interval = batch_ack_interval
+        self._batch_session = uuid.uuid4().hex[:12]
+        self._batch_seqs = [0] * max_in_flight
+        # (seq, [(entity_id, content_hash, attributes_hash), ...]) of the posted batches, by worker
+        self._unconfirmed = [deque(maxlen=MAX_UNCONFIRMED_BATCHES) for _ in range(max_in_flight)]
+        self._last_batch = {}
+        self._next_ack_check = 0.
+        self._flush_interval = flush_interval
+        self._probe_interval = probe_interval
+        self._replay_rate = replay_rate
+        self._log = log
+
+        self._spool = OutboundSpool(spool_path) if spool_path else None
+        # Offline: the master is unreachable. Spooling: the new states go to the spool (offline or replaying)
+        self._offline = False
+        self._spooling = self._spool is not None and len(self._spool) > 0
+        self._next_probe = 0.
+        self._num_spooled = 0
+        self._num_replayed = 0
+        self._num_requests = 0
+        self._num_failures = 0
+        self._num_states_sent = 0
+        self._bytes_sent = 0
+        self._latency = LatencyHistogram()
+
+        self._lock = Lock()
+        self._buffer = OrderedDict()
+        self._num_enqueued = 0
+        self._num_flushed = 0
+        self._max_buffer_depth = 0
+        self._acked = {}
+        self._acked_attributes = {}
+        self._stop = Event()
+
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._session.headers.update({'Content-Type': 'application/json'})
+        if api_key:
+            self._session.headers[HEADER_HA_ACCESS] = api_key
+
+        self._queues = [Queue() for _ in range(max_in_flight)]
+        self._workers = [Thread(target=self._worker, args=(i, q), name='master_transport_{}'.format(i), daemon=True)
+                         for i, q in enumerate(self._queues)]
+        for worker in self._workers:
+            worker.start()
+        self._flusher = None
+        if flush_interval > 0 or self._spool is not None or batch_event is not None:
+            self._flusher = Thread(target=self._flusher_loop, name='master_transport_flusher', daemon=True)
+            self._flusher.start()
+
+    def __repr__(self):
+        return '<MasterTransport {}>'.format(self.base_url)
+
+    def set_state(self, entity_id, state, attributes=None):
+        """Queue a state to set in the master (replacing any pending state of the same entity)."""
+        attributes = attributes or {}
+        if self._flush_interval <= 0 and not self._spooling:
+            with self._lock:
+                self._num_enqueued += 1
+                self._num_flushed += 1
+            self._dispatch([(entity_id, state, attributes, time())])
+            return
+        with self._lock:
+            self._num_enqueued += 1
+            self._buffer[entity_id] = (state, attributes)
+            self._max_buffer_depth = max(self._max_buffer_depth, len(self._buffer))
+
+    def flush(self):
+        """Hand the buffered states to the workers (or to the spool, while the master is offline or replaying)."""
+        with self._lock:
+            buffer, self._buffer = self._buffer, OrderedDict()
+            self._num_flushed += len(buffer)
+        ts = time()
+        if self._spooling:
+            self._spool_states([(entity_id, state, attributes, ts)
+                                for entity_id, (state, attributes) in buffer.items()])
+            return
+        self._dispatch([(entity_id, state, attributes, ts) for entity_id, (state, attributes) in buffer.items()])
+
+    @property
+    def online(self):
+        """The master is reachable."""
+        return not self._offline
+
+    def acked_hash(self, entity_id):
+        """Content hash of the last state of an entity acknowledged by the master (None if never)."""
+        return self._acked.get(entity_id)
+
+    def set_acked(self, entity_id, content_hash):
+        """Record the content hash of a state that the master already has (so it's not resent)."""
+        self._acked[entity_id] = content_hash
+
+    def get_states(self):
+        """Current states in the master (`GET /api/states`, blocking), or None if the request fails."""
+        try:
+            resp = self._session.get('{}/api/states'.format(self.base_url), timeout=self._timeout)
+            if resp.status_code == 200:
+                return resp.json()
+            self._log_error('Error getting the master states: {} - {}'.format(resp.status_code, resp.text))
+        except (requests.exceptions.RequestException, ValueError) as exc:
+            self._log_error('Error getting the master states: {}'.format(exc))
+        return None
+
+    def stats(self, reset_latency=False):
+        """Counters of the outbound queue (coalescing ratio and queue depths) and of the requests to the master.
+
+        The latency percentiles are of the requests since the start, or since the last `reset_latency`."""
+        with self._lock:
+            enqueued, flushed = self._num_enqueued, self._num_flushed
+            stats = {'enqueued': enqueued,
+                     'flushed': flushed,
+                     'coalescing_ratio': round(1 - flushed / enqueued, 3) if enqueued else 0.,
+                     'buffer_depth': len(self._buffer),
+                     'max_buffer_depth': self._max_buffer_depth,
+                     'requests': self._num_requests,
+                     'failures': self._num_failures,
+                     'states_sent': self._num_states_sent,
+                     'bytes_sent': self._bytes_sent,
+                     'spooled': self._num_spooled,
+                     # States resent from the spool
+                     'retries': self._num_replayed}
+        stats.update(queue_depth=sum(q.qsize() for q in self._queues),
+                     unconfirmed_batches=sum(len(batches) for batches in self._unconfirmed),
+                     online=not self._offline,
+                     spool_depth=len(self._spool) if self._spool is not None else 0,
+                     latency=self._latency.summary(reset=reset_latency))
+        return stats
+
+    def stop(self, timeout=DEFAULT_TIMEOUT):
+        """Stop the workers, after posting the queued states (waiting up to `timeout` secs), and close the session."""
+        self._stop.set()
+        if self._flusher is not None:
+            self._flusher.join(timeout)
+        self.flush()
+        for q in self._queues:
+            q.put(None)
+        for worker in self._workers:
+            worker.join(timeout)
+        self._session.close()
+        if self._spool is not None:
+            self._spool.close()
+
+    def _post_states(self, items, worker=0):
+        """POST a list of (entity_id, state, attributes, ts), one by one or as a batch event."""
+        attrs_hashes = [attributes_hash(item[2]) for item in items]
+        seq = None
+        if self._batch_event is None:
+            # The REST API replaces all the attributes, so they are always sent
+            entity_id, state, attributes, _ = items[0]
+            what, url = entity_id, '{}/api/states/{}'.format(self.base_url, entity_id)
+            data = {'state': state, 'attributes': attributes}
+        else:
+            what, url = '{} states'.format(len(items)), '{}/api/events/{}'.format(self.base_url, self._batch_event)
+            self._batch_seqs[worker] += 1
+            seq = self._batch_seqs[worker]
+            states = []
+            with self._lock:
+                for (entity_id, state, attributes, _), attrs_hash in zip(items, attrs_hashes):
+                    # Not acknowledged again until the receiver confirms this batch
+                    self._acked.pop(entity_id, None)
+                    if self._acked_attributes.pop(entity_id, None) == attrs_hash:
+                        attributes = None
+                    self._last_batch[entity_id] = seq
+                    states.append((entity_id, state, attributes))
+            data = batch_event_data(states, ack={'entity_id': self._batch_ack_entity, 'session': self._batch_session,
+                                                 'worker': worker, 'seq': seq})
+        if self._offline:
+            # Another worker has found the master down: don't wait for another timeout
+            self._spool_states(items)
+            return False
+        body = json.dumps(data)
+        with self._lock:
+            self._num_requests += 1
+            self._bytes_sent += len(body.encode())
+        tic = monotonic()
+        try:
+            resp = self._session.post(url, data=body, timeout=self._timeout)
+            self._latency.add(monotonic() - tic)
+            if resp.status_code in (200, 201):
+                # = state_hash(state, attributes)
+                acked = [(entity_id, hash((str(state), attrs_hash)), attrs_hash)
+                         for (entity_id, state, _, _), attrs_hash in zip(items, attrs_hashes)]
+                with self._lock:
+                    self._num_states_sent += len(items)
+                    if seq is not None:
+                        # Fired, but not applied yet: acknowledged when the receiver confirms it
+                        self._unconfirmed[worker].append((seq, acked))
+                        return True
+                    for entity_id, content_hash, attrs_hash in acked:
+                        self._acked[entity_id] = content_hash
+                        self._acked_attributes[entity_id] = attrs_hash
+                return True
+            with self._lock:
+                self._num_failures += 1
+            self._log_error('Error setting {} in master: {} - {}'.format(what, resp.status_code, resp.text))
+            if resp.status_code < 500:
+                # Rejected by the master: resending it won't help
+                return False
+        except requests.exceptions.RequestException as exc:
+            with self._lock:
+                self._num_failures += 1
+            self._log_error('Error setting {} in master: {}'.format(what, exc))
+        if self._spool is not None:
+            self._go_offline()
+            self._spool_states(items)
+        return False
+
+    def _spool_states(self, items):
+        for item in items:
+            self._spool.put(*item)
+        with self._lock:
+            self._num_spooled += len(items)
+
+    def _go_offline(self):
+        with self._lock:
+            if self._offline:
+                return
+            self._offline = self._spooling = True
+            self._next_probe = monotonic() + self._probe_interval
+        self._log_error('Master {} is unreachable, spooling states in {}'.format(self.base_url, self._spool.path))
+
+    def _probe(self):
+        try:
+            return self._session.get('{}/api/'.format(self.base_url), timeout=self._timeout).status_code == 200
+        except requests.exceptions.RequestException:
+            return False
+
+    def _replay(self, interval):
+        """Hand to the workers the spooled states allowed by the replay rate in `interval` seconds."""
+        if self._offline:
+            if monotonic() < self._next_probe:
+                return
+            if not self._probe():
+                self._next_probe = monotonic() + self._probe_interval
+                return
+            self._offline = False
+            # The master may have been restarted (and lost the states)
+            with self._lock:
+                self._acked.clear()
+                self._acked_attributes.clear()
+                for batches in self._unconfirmed:
+                    batches.clear()
+            if self._log is not None:
+                self._log('Master {} is back, replaying {} spooled states'.format(self.base_url, len(self._spool)))
+        with self._lock:
+            # The (final) flush of the buffer and this check can't interleave
+            items = self._spool.pop(max(1, int(self._replay_rate * interval)))
+            if not items:
+                self._spooling = False
+                return
+        self._dispatch(items)
+        with self._lock:
+            self._num_replayed += len(items)
+
+    def _check_batch_acks(self):
+        """Acknowledge the states of the batches confirmed by the receiver in the ack entity of the master."""
+        if self._offline or monotonic() < self._next_ack_check or not any(self._unconfirmed):
+            return
+        self._next_ack_check = monotonic() + self._batch_ack_interval
+        url = '{}/api/states/{}'.format(self.base_url, self._batch_ack_entity)
+        try:
+            resp = self._session.get(url, timeout=self._timeout)
+            if resp.status_code == 404:
+                # Nothing confirmed yet (or no receiver)
+                return
+            if resp.status_code != 200:
+                self._log_error('Error getting the batch acks: {} - {}'.format(resp.status_code, resp.text))
+                return
+            ack_state = resp.json()
+        except (requests.exceptions.RequestException, ValueError) as exc:
+            self._log_error('Error getting the batch acks: {}'.format(exc))
+            return
+        if ack_state.get('state') != self._batch_session:
+            return
+        confirmed = ack_state.get('attributes') or {}
+        with self._lock:
+            for worker, batches in enumerate(self._unconfirmed):
+                last_seq = confirmed.get(BATCH_ACK_ATTRIBUTE.format(worker), 0)
+                while batches and batches[0][0] <= last_seq:
+                    seq, acked = batches.popleft()
+                    for entity_id, content_hash, attrs_hash in acked:
+                        if self._last_batch.get(entity_id) == seq:
+                            # Not sent again in a later batch
+                            self._acked[entity_id] = content_hash
+                            self._acked_attributes[entity_id] = attrs_hash
+
+    def _dispatch(self, items):
+        """Hand (entity_id, state, attributes, ts) items to the workers, always the same one for each entity."""
+        if self._batch_event is None:
+            for item in items:
+                self._queues[hash(item[0]) % len(self._queues)].put([item])
+            return
+        shards = [[] for _ in self._queues]
+        for item in items:
+            shards[hash(item[0]) % len(shards)].append(item)
+        for queue, shard in zip(self._queues, shards):
+            for i in range(0, len(shard), self._batch_size):
+                queue.put(shard[i:i + self._batch_size])
+
+    def _flusher_loop(self):
+        interval = self._flush_interval if self._flush_interval > 0 else DEFAULT_FLUSH_INTERVAL
+        while not self._stop.wait(interval):
+            try:
+                self.flush()
+                if self._spooling:
+                    self._replay(interval)
+                if self._batch_event is not None:
+                    self._check_batch_acks()
+            except Exception:
+                self._log_error('Error in the master transport flusher:\n{}'.format(traceback.format_exc()), 'ERROR')
+
+    def _log_error(self, msg, level='WARNING'):
+        if self._log is not None:
+            self._log(msg, level)
+
+    def _worker(self, worker, queue):
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            try:
+                self._post_states(item, worker)
+            except Exception:
+                self._log_error('Error posting {} states to the master:\n{}'
+                                .format(len(item), traceback.format_exc()), 'ERROR')
@@ -49,8 +49,8 @@ from functools import reduce
 from itertools import cycle
 from jinja2 import Environment, FileSystemLoader
 import json
-from math import ceil
 import os
+from raw_sensors_engine import ENGINE
 import re
 import requests
 from time import time, sleep
@@ -189,10 +189,6 @@ class MotionAlarm(appapi.AppDaemon):
     _known_devices = None
 
     _raw_sensors = None
-    _raw_sensors_sufix = None
-    _raw_sensors_seconds_to_off = None
-    _raw_sensors_last_states = {}
-    _raw_sensors_attributes = {}
 
     def initialize(self):
         """AppDaemon required method for app init."""
@@ -209,7 +205,6 @@ class MotionAlarm(appapi.AppDaemon):
         self._main_switch = self.args.get('main_switch')
 
         # Sensores de movimiento (PIR's, cam_movs, extra)
-        self._raw_sensors = self.args.get('raw_binary_sensors', None)
         self._pirs = self._listconf_param(self.args, 'pirs')
         self._camera_movs = self._listconf_param(self.args, 'camera_movs')
         self._extra_sensors = self._listconf_param(self.args, 'extra_sensors')
@@ -272,25 +267,7 @@ class MotionAlarm(appapi.AppDaemon):
         #          .format(self._retry_push_alarm, self._max_time_sirena_on))
 
         # RAW SENSORS:
-        if self._raw_sensors is not None:
-            self._raw_sensors = self._raw_sensors.split(',')
-            self._raw_sensors_sufix = self.args.get('raw_binary_sensors_sufijo', '_raw')
-            # Persistencia en segundos de último valor hasta considerarlos 'off'
-            self._raw_sensors_seconds_to_off = int(self.args.get('raw_binary_sensors_time_off', DEFAULT_RAWBS_SECS_OFF))
-
-            # Handlers de cambio en raw binary_sensors:
-            l1, l2 = 'attributes', 'last_changed'
-            for s in self._raw_sensors:
-                self._raw_sensors_attributes[s] = (s.replace(self._raw_sensors_sufix, ''), self.get_state(s, l1))
-                # self._raw_sensors_last_states[s] = [parse(self.get_state(s, l2)).replace(tzinfo=None), False]
-                self._raw_sensors_last_states[s] = [self.datetime(), False]
-                self.listen_state(self._turn_on_raw_sensor_on_change, s)
-            # self.log('seconds_to_off: {}'.format(self._raw_sensors_seconds_to_off))
-            # self.log('attributes_sensors: {}'.format(self._raw_sensors_attributes))
-            # self.log('last_changes: {}'.format(self._raw_sensors_last_states))
-            [self.set_state(dev, state='off', attributes=attrs) for dev, attrs in self._raw_sensors_attributes.values()]
-            next_run = self.datetime() + dt.timedelta(seconds=self._raw_sensors_seconds_to_off)
-            self.run_every(self._turn_off_raw_sensor_if_not_updated, next_run, self._raw_sensors_seconds_to_off)
+        self._init_raw_sensors()
 
         self._events_data = []
 
@@ -361,24 +338,19 @@ class MotionAlarm(appapi.AppDaemon):
             return [default] * min_len
         return []
 
-    # noinspection PyUnusedLocal
-    def _turn_on_raw_sensor_on_change(self, entity, attribute, old, new, kwargs):
-        _, last_st = self._raw_sensors_last_states[entity]
-        self._raw_sensors_last_states[entity] = [self.datetime(), True]
-        if not last_st:
-            name, attrs = self._raw_sensors_attributes[entity]
-            self.set_state(name, state='on', attributes=attrs)
-            # self.log('TURN ON "{}" (de {} a {} --> {})'.format(entity, old, new, name))
+    def _init_raw_sensors(self):
+        """Registro de los raw binary_sensors en el motor común."""
+        self._raw_sensors = ENGINE.register_from_args(self, self.args, self._publish_raw_sensor_states,
+                                                      seconds_to_off=DEFAULT_RAWBS_SECS_OFF, initial_off=True)
 
-    # noinspection PyUnusedLocal
-    def _turn_off_raw_sensor_if_not_updated(self, *kwargs):
-        now = self.datetime()
-        for s, (ts, st) in self._raw_sensors_last_states.copy().items():
-            if st and ceil((now - ts).total_seconds()) >= self._raw_sensors_seconds_to_off:
-                # self.log('TURN OFF "{}" (last ch: {})'.format(s, ts))
-                name, attrs = self._raw_sensors_attributes[s]
-                self._raw_sensors_last_states[s] = [now, False]
-                self.set_state(name, state='off', attributes=attrs)
+    def terminate(self):
+        """AppDaemon method called before app reload."""
+        ENGINE.unregister(self)
+
+    def _publish_raw_sensor_states(self, updates):
+        for name, state, attributes in updates:
+            self.set_state(name, state=state, attributes=attributes)
+            # self.log('TURN {} "{}"'.format(state.upper(), name))
 
     def _listen_to_switch(self, identif, entity_switch, func_listen_change):
         if type(entity_switch) is bool:
@@ -6,183 +6,394 @@ This little app controls some hue lights for turning them ON with motion detecti
 only under some custom circunstances, like the media player is not running,
 or there aren't any more lights in 'on' state in the room.
 
+One app instance can manage multiple rooms (`rooms` list), with the light
+states mirrored in memory, one resettable turn off deadline per room, and
+latency metrics as a sensor. The args are documented in the README.
+
+The AppDaemon constraints of the app also gate its state callbacks, so, with
+`constrain_*` args, a periodic probe (gated too) detects when they have held,
+and the mirrored states are refreshed at the next decision after that.
+
 """
 import appdaemon.appapi as appapi
+import datetime as dt
+from ha_datetime import parse_ha_datetime
+from hires_timer import TIMER
+from latency_histogram import LatencyHistogram
+from lights_mirror import LightsMirror
+from time import monotonic
 
 
 LOG_LEVEL = 'INFO'
+ROLE_PIR = 'pir'
+ROLE_MEDIA_PLAYER = 'media_player'
+ROLE_EXTRA_CONSTRAIN = 'constrain_input_boolean_2'
+ROLE_TIMEOUT = 'motion_light_timeout'
+ROLE_LIGHT = 'light'
+LATENCY_DISPATCH = 'dispatch'
+LATENCY_SERVICE = 'service'
+LATENCY_TOTAL = 'total'
+LATENCY_OFF_DELAY = 'off_delay'
+DEFAULT_LATENCY_SENSOR = 'sensor.motion_lights_latency'
+DEFAULT_LATENCY_BUDGET_MS = 500
+DEFAULT_LATENCY_PUBLISH_INTERVAL = 60
+CONSTRAINTS_PROBE_INTERVAL = 5
+
+
+class MotionRoom(object):
+    """Config & state of the motion lights of one room."""
+
+    def __init__(self, name, pir, lights_motion, lights_check_off,
+                 timeout_slider, media_player, extra_constrain_input_boolean):
+        self.name = name
+        self.pir = pir
+        self.lights_motion = lights_motion
+        self.lights_check_off = lights_check_off
+        self.timeout_slider = timeout_slider
+        self.media_player = media_player
+        self.extra_constrain_input_boolean = extra_constrain_input_boolean
+        self.group_motion = '{}_motion'.format(name)
+        self.group_check_off = '{}_check_off'.format(name)
+
+        self.motion_light_timeout = None
+        self.off_timer = None
+        self.pir_off_since = None
+        self.motion_lights_running = False
+        self.extra_condition = True
+        self.media_player_active = False
+        self.latency = {stage: LatencyHistogram() for stage in (
+            LATENCY_DISPATCH, LATENCY_SERVICE, LATENCY_TOTAL,
+            LATENCY_OFF_DELAY)}
+
+    def __repr__(self):
+        return '<MotionRoom {}>'.format(self.name)
 
 
 # noinspection PyClassHasNoInit
 class MotionLights(appapi.AppDaemon):
     """App for control lights with a motion sensor."""
 
-    _pir = None
-    _motion_light_timeout = None
-    _lights_motion = None
-    _lights_check_off = None
-    _media_player = None
-    _extra_constrain_input_boolean = None
+    _rooms = None
+    _rooms_by_name = None
+    _index = None
+    _mirror = None
 
-    _handle_motion_on = None
-    _handle_motion_off = None
-
-    _motion_lights_running = False
-    _extra_condition = True
-    _media_player_active = False
-    _lights_motion_active = None
+    _latency_total = None
+    _latency_budget = None
+    _latency_sensor = None
+    _constrained = None
+    _last_ungated = None
 
     def initialize(self):
         """AppDaemon required method for app init."""
         conf_data = dict(self.config['AppDaemon'])
-        pir = self.args.get('pir', None)
-        self._extra_constrain_input_boolean = self.args.get(
-            'constrain_input_boolean_2', None)
-        motion_light_timeout_slider = self.args.get(
-            'motion_light_timeout', None)
-        self._lights_motion = self.args.get('lights_motion', '')
-        self._lights_check_off = [l for l in self.args.get(
-            'lights_check_off', '').split(',') if len(l) > 0]
-        self._media_player = conf_data.get('media_player', None)
-
-        if pir and motion_light_timeout_slider and self._lights_motion:
-            self._pir = pir
-            # Motion Lights States
-            self._lights_motion_active = {}
-            self._read_light_motion_states(set_listen_state=True)
-            self.run_minutely(self._read_light_motion_states, None)
-            # for l in self._lights_motion.split(','):
-            #     self._lights_motion_active[l] = self.get_state(l) == 'on'
-            #     self.listen_state(self._light_motion_state, l)
-            # Light Timeout
-            if motion_light_timeout_slider.startswith('input_number'):
-                self._motion_light_timeout = int(
-                    round(float(self.get_state(motion_light_timeout_slider))))
-                self.listen_state(
-                    self._set_motion_timeout, motion_light_timeout_slider)
+        default_media_player = conf_data.get('media_player', None)
+        rooms_args = self.args.get('rooms') or [self.args]
+        # AppDaemon constraints: the state callbacks can be missed
+        self._constrained = any(arg.startswith('constrain_')
+                                and arg != ROLE_EXTRA_CONSTRAIN
+                                for arg in self.args)
+        self._rooms = []
+        for room_args in rooms_args:
+            room = self._make_room(room_args, default_media_player)
+            if room is not None:
+                self._rooms.append(room)
+        if not self._rooms:
+            return
+        self._rooms_by_name = {room.name: room for room in self._rooms}
+
+        # Index: role -> entity -> rooms
+        self._index = {role: {} for role in (
+            ROLE_PIR, ROLE_MEDIA_PLAYER, ROLE_EXTRA_CONSTRAIN,
+            ROLE_TIMEOUT, ROLE_LIGHT)}
+        for room in self._rooms:
+            for role, entities in (
+                    (ROLE_PIR, [room.pir]),
+                    (ROLE_MEDIA_PLAYER, [room.media_player]),
+                    (ROLE_EXTRA_CONSTRAIN,
+                     [room.extra_constrain_input_boolean]),
+                    (ROLE_TIMEOUT, [room.timeout_slider]),
+                    (ROLE_LIGHT, room.lights_motion)):
+                for entity in entities:
+                    if entity is not None:
+                        self._index[role].setdefault(entity, []).append(room)
+
+        # Motion Lights States
+        self._mirror = LightsMirror(self, on_change=self._light_changed)
+        for room in self._rooms:
+            self._mirror.add_group(room.group_motion, room.lights_motion)
+            self._mirror.add_group(room.group_check_off,
+                                   room.lights_check_off)
+        self.log('Light states: {}'.format(self._mirror))
+
+        # Light Timeout
+        for slider, rooms in self._index[ROLE_TIMEOUT].items():
+            if slider.startswith('input_number'):
+                timeout = int(round(float(self.get_state(slider))))
+                self.listen_state(self._set_motion_timeout, slider)
             else:
-                self._motion_light_timeout = int(
-                    round(float(motion_light_timeout_slider)))
-            self._handle_motion_on = self.listen_state(
-                self.turn_on_motion_lights, self._pir, new="on")
-            self._handle_motion_off = self.listen_state(
-                self.turn_off_motion_lights, self._pir,
-                new="off", duration=self._motion_light_timeout)
-            # Media player dependency
-            if self._media_player is not None:
-                self._media_player_active = self.get_state(
-                    self._media_player) == 'playing'
-                self.listen_state(
-                    self._media_player_state_ch, self._media_player)
-                self.log('MotionLightsConstrain media player "{}" (PIR={})'
-                         .format(self._media_player, self._pir))
-
-            # Extra dependency (inverse logic) --> GENERAL ALARM ON
-            if self._extra_constrain_input_boolean is not None:
-                self._extra_condition = self.get_state(
-                    self._extra_constrain_input_boolean) == 'off'
-                self.listen_state(
-                    self._extra_switch_change,
-                    self._extra_constrain_input_boolean)
-                self.log('MotionLightsConstrain extra "{}" (extra_cond now={})'
-                         .format(self._extra_constrain_input_boolean,
-                                 self._extra_condition))
-            self.log('MotionLights [{}] with motion in "{}", '
+                timeout = int(round(float(slider)))
+            for room in rooms:
+                room.motion_light_timeout = timeout
+        for pir in self._index[ROLE_PIR]:
+            # With attribute='all', for the `last_changed` of the PIR
+            self.listen_state(self._pir_changed, pir, attribute='all')
+
+        # Media player dependency
+        for media_player, rooms in self._index[ROLE_MEDIA_PLAYER].items():
+            active = self.get_state(media_player) == 'playing'
+            for room in rooms:
+                room.media_player_active = active
+            self.listen_state(self._media_player_state_ch, media_player)
+            self.log('MotionLightsConstrain media player "{}" (rooms={})'
+                     .format(media_player, rooms))
+
+        # Extra dependency (inverse logic) --> GENERAL ALARM ON
+        for input_b, rooms in self._index[ROLE_EXTRA_CONSTRAIN].items():
+            extra_condition = self.get_state(input_b) == 'off'
+            for room in rooms:
+                room.extra_condition = extra_condition
+            self.listen_state(self._extra_switch_change, input_b)
+            self.log('MotionLightsConstrain extra "{}" (extra_cond now={})'
+                     .format(input_b, extra_condition))
+        # Latency metrics
+        self._latency_total = LatencyHistogram()
+        self._latency_budget = float(self.args.get(
+            'latency_budget_ms', DEFAULT_LATENCY_BUDGET_MS)) / 1000.
+        self._latency_sensor = self.args.get(
+            'latency_sensor', DEFAULT_LATENCY_SENSOR)
+        interval = int(self.args.get('latency_publish_interval',
+                                     DEFAULT_LATENCY_PUBLISH_INTERVAL))
+        if interval > 0:
+            self.run_every(self._publish_latency,
+                           self.datetime() + dt.timedelta(seconds=interval),
+                           interval)
+        # Constraints probe: not called while they hold, as the state callbacks
+        if self._constrained:
+            self._last_ungated = monotonic()
+            self.run_every(self._constraints_probe,
+                           self.datetime() + dt.timedelta(
+                               seconds=CONSTRAINTS_PROBE_INTERVAL),
+                           CONSTRAINTS_PROBE_INTERVAL)
+        for room in self._rooms:
+            self.log('MotionLights {} [{}] with motion in "{}", '
                      'with timeout={} s, check_off={}. ---> ACTIVE'
-                     .format(self._lights_motion, self._pir,
-                             self._motion_light_timeout,
-                             self._lights_check_off))
-        else:
+                     .format(room.name, room.lights_motion, room.pir,
+                             room.motion_light_timeout,
+                             room.lights_check_off))
+
+    def terminate(self):
+        """AppDaemon method called before app reload."""
+        for room in self._rooms or []:
+            if room.off_timer is not None:
+                TIMER.cancel(room.off_timer)
+
+    def _make_room(self, room_args, default_media_player):
+        pir = room_args.get('pir', None)
+        motion_light_timeout_slider = room_args.get(
+            'motion_light_timeout', None)
+        lights_motion = room_args.get('lights_motion', '')
+        if not (pir and motion_light_timeout_slider and lights_motion):
             self.log('No se inicializa MotionLights, '
                      'faltan parámetros (req: {})'
                      .format('motion_light_timeout, lights_motion, pir'),
                      level='ERROR')
+            return None
+        lights_check_off = [l for l in room_args.get(
+            'lights_check_off', '').split(',') if len(l) > 0]
+        return MotionRoom(
+            room_args.get('name', pir.split('.')[-1]), pir,
+            lights_motion.split(','), lights_check_off,
+            str(motion_light_timeout_slider),
+            room_args.get('media_player', default_media_player),
+            room_args.get('constrain_input_boolean_2', None))
 
     # noinspection PyUnusedLocal
     def _media_player_state_ch(self, entity, attribute, old, new, kwargs):
-        self._media_player_active = new == 'playing'
+        for room in self._index[ROLE_MEDIA_PLAYER][entity]:
+            room.media_player_active = new == 'playing'
 
     # noinspection PyUnusedLocal
     def _extra_switch_change(self, entity, attribute, old, new, kwargs):
         self.log('Extra switch condition change: {} from {} to {}'
                  .format(entity, old, new))
-        self._extra_condition = new == 'off'
+        for room in self._index[ROLE_EXTRA_CONSTRAIN][entity]:
+            room.extra_condition = new == 'off'
 
     # noinspection PyUnusedLocal
     def _set_motion_timeout(self, entity, attribute, old, new, kwargs):
         new_timeout = int(round(float(new)))
-        if new_timeout != self._motion_light_timeout:
-            self._motion_light_timeout = new_timeout
-            if self._handle_motion_off is not None:
-                self.log('Cancelling {}'.format(self._handle_motion_off))
-                self.cancel_listen_state(self._handle_motion_off)
-            self._handle_motion_off = self.listen_state(
-                self.turn_off_motion_lights, self._pir,
-                new="off", duration=self._motion_light_timeout)
-            self.log('Se establece nuevo timeout para MotionLights: {} segs'
-                     .format(self._motion_light_timeout))
+        for room in self._index[ROLE_TIMEOUT][entity]:
+            if new_timeout != room.motion_light_timeout:
+                room.motion_light_timeout = new_timeout
+                if room.pir_off_since is not None \
+                        and room.off_timer.pending:
+                    TIMER.reschedule(room.off_timer,
+                                     room.pir_off_since + new_timeout)
+                self.log('Se establece nuevo timeout para MotionLights {}: '
+                         '{} segs'.format(room.name, new_timeout))
+
+    def _light_changed(self, entity, old, new):
+        if new == 'on':
+            return
+        for room in self._index[ROLE_LIGHT].get(entity, ()):
+            if room.motion_lights_running:
+                self.log('MOTION LIGHTS OFF in {} (some lights were turn off '
+                         'manually) --> {}'.format(
+                             room.name,
+                             self._mirror.group_states(room.group_motion)))
+                room.motion_lights_running = False
 
     # noinspection PyUnusedLocal
-    def _read_light_motion_states(self, set_listen_state=False, **kwargs):
-        bkp = self._lights_motion_active.copy()
-        if not self._motion_lights_running:
-            for l in self._lights_motion.split(','):
-                self._lights_motion_active[l] = self.get_state(l) == 'on'
-                if set_listen_state:
-                    self.listen_state(self._light_motion_state, l)
-        elif any(filter(lambda x: x is False,
-                        self._lights_motion_active.values())):
-            self.log('MOTION LIGHTS OFF (some lights were turn off manually)'
-                     ' --> {}'.format(self._lights_motion_active))
-            self._motion_lights_running = False
-        if set_listen_state or (bkp != self._lights_motion_active):
-            self.log('UPDATE light_motion_states from {} to {}'
-                     .format(bkp, self._lights_motion_active,
-                             set_listen_state))
+    def _constraints_probe(self, kwargs):
+        self._last_ungated = monotonic()
+
+    def _resync_if_gated(self):
+        """Refresh the states that the constraints of the app could have
+        frozen (their callbacks are not called while constrained), only if
+        the constraints probe has missed its last calls."""
+        if not self._constrained:
+            return
+        now = monotonic()
+        gated_for = now - self._last_ungated
+        self._last_ungated = now
+        if gated_for < 1.5 * CONSTRAINTS_PROBE_INTERVAL:
+            return
+        self.log('Constraints held for {:.0f} s, refreshing states'
+                 .format(gated_for), 'DEBUG')
+        self._mirror.resync()
+        for media_player, rooms in self._index[ROLE_MEDIA_PLAYER].items():
+            active = self.get_state(media_player) == 'playing'
+            for room in rooms:
+                room.media_player_active = active
+        for input_b, rooms in self._index[ROLE_EXTRA_CONSTRAIN].items():
+            extra_condition = self.get_state(input_b) == 'off'
+            for room in rooms:
+                room.extra_condition = extra_condition
+
+    def _lights_are_off(self, room, include_motion_lights=True):
+        if self._mirror.any_on(room.group_check_off):
+            return False
+        return not (include_motion_lights
+                    and self._mirror.any_on(room.group_motion))
 
     # noinspection PyUnusedLocal
-    def _light_motion_state(self, entity, attribute, old, new, kwargs):
-        self._lights_motion_active[entity] = new == 'on'
-
-    def _lights_are_off(self, include_motion_lights=True):
-        other_lights_are_off = ((self._lights_check_off is None)
-                                or all([(self.get_state(l) == 'off')
-                                        or (self.get_state(l) is None)
-                                        for l in self._lights_check_off]))
-        if include_motion_lights:
-            return other_lights_are_off and not any(
-                self._lights_motion_active.values())
-        return other_lights_are_off
+    def _publish_latency(self, kwargs):
+        """Set the latency percentiles of the last interval as a sensor."""
+        attributes = {'friendly_name': 'Motion lights latency',
+                      'unit_of_measurement': 'ms',
+                      'icon': 'mdi:timer',
+                      'budget_ms': round(self._latency_budget * 1000)}
+        for room in self._rooms:
+            for stage, histogram in room.latency.items():
+                summary = histogram.summary(reset=True)
+                for key in ('count', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms'):
+                    attributes['{}_{}_{}'.format(
+                        room.name, stage, key)] = summary[key]
+        total = self._latency_total.summary(reset=True)
+        attributes.update({'total_' + key: value
+                           for key, value in total.items()})
+        attributes.update({'light_commands_sent': self._mirror.commands_sent,
+                           'light_commands_skipped':
+                               self._mirror.commands_skipped})
+        self.set_state(self._latency_sensor, state=total['p95_ms'],
+                       attributes=attributes)
 
     # noinspection PyUnusedLocal
-    def turn_on_motion_lights(self, entity, attribute, old, new, kwargs):
+    def _pir_changed(self, entity, attribute, old, new, kwargs):
+        tic = monotonic()
+        if not new or (old and old['state'] == new['state']):
+            return
+        if new['state'] == 'on':
+            for room in self._index[ROLE_PIR][entity]:
+                room.pir_off_since = None
+                if room.off_timer is not None:
+                    TIMER.cancel(room.off_timer)
+            self.turn_on_motion_lights(entity, new, tic)
+            return
+        for room in self._index[ROLE_PIR][entity]:
+            room.pir_off_since = tic
+            deadline = tic + room.motion_light_timeout
+            if room.off_timer is None:
+                room.off_timer = TIMER.call_at(
+                    deadline, self._motion_timeout_expired, room, log=self.log)
+            else:
+                TIMER.reschedule(room.off_timer, deadline)
+
+    def _motion_timeout_expired(self, room):
+        # In the timer thread: the service call goes to an AppDaemon thread
+        self.run_in(self.turn_off_motion_lights, 0, room=room.name)
+
+    def turn_on_motion_lights(self, entity, new, tic):
         """Method for turning on the motion-controlled lights."""
-        if (not self._motion_lights_running and
-                self._lights_are_off(include_motion_lights=True) and
-                self._extra_condition and not self._media_player_active):
-            self._motion_lights_running = True
-            self.log('TURN_ON MOTION_LIGHTS ({}), with timeout: {} sec. '
-                     'lights_motion: {}'
-                     .format(self._lights_motion, self._motion_light_timeout,
-                             self._lights_motion_active.values()),
-                     LOG_LEVEL)
-            self.call_service("light/turn_on", entity_id=self._lights_motion,
-                              color_temp=300, brightness=200, transition=0)
+        # PIR on --> callback
+        now = dt.datetime.now(tz=dt.timezone.utc)
+        ts_pir = parse_ha_datetime(new.get('last_changed'))
+        dispatch = 0.
+        if ts_pir is not None:
+            if ts_pir.tzinfo is None:
+                ts_pir = ts_pir.replace(tzinfo=dt.timezone.utc)
+            dispatch = max(0., (now - ts_pir).total_seconds())
+        self._resync_if_gated()
+        for room in self._index[ROLE_PIR][entity]:
+            room.latency[LATENCY_DISPATCH].add(dispatch)
+            if (not room.motion_lights_running and
+                    self._lights_are_off(room, include_motion_lights=True) and
+                    room.extra_condition and not room.media_player_active):
+                room.motion_lights_running = True
+                self.log('TURN_ON MOTION_LIGHTS in {} ({}), with timeout: '
+                         '{} sec. lights_motion: {}'
+                         .format(room.name, room.lights_motion,
+                                 room.motion_light_timeout,
+                                 self._mirror.group_states(room.group_motion)),
+                         LOG_LEVEL)
+                self._mirror.turn_on(room.lights_motion, transition=0,
+                                     color_temp=300, brightness=200)
+                # callback --> light/turn_on done
+                service = monotonic() - tic
+                total = dispatch + service
+                room.latency[LATENCY_SERVICE].add(service)
+                room.latency[LATENCY_TOTAL].add(total)
+                self._latency_total.add(total)
+                if total > self._latency_budget:
+                    self.log('SLOW MOTION_LIGHTS in {}: {:.0f} ms (dispatch '
+                             '{:.0f} ms + service {:.0f} ms) > budget {:.0f} ms'
+                             .format(room.name, total * 1000, dispatch * 1000,
+                                     service * 1000,
+                                     self._latency_budget * 1000), 'WARNING')
 
-    # noinspection PyUnusedLocal
-    def turn_off_motion_lights(self, entity, attribute, old, new, kwargs):
+    def turn_off_motion_lights(self, kwargs):
         """Method for turning off the motion-controlled lights
         after some time without any movement."""
-        if self._motion_lights_running and \
-                self._extra_condition and not self._media_player_active:
-            if self._lights_are_off(include_motion_lights=False):
-                self.log('TURNING_OFF MOTION_LIGHTS, id={}, old={}, new={}'
-                         .format(entity, old, new), LOG_LEVEL)
-                self.call_service("light/turn_off",
-                                  entity_id=self._lights_motion, transition=1)
+        room = self._rooms_by_name[kwargs['room']]
+        off_since = room.pir_off_since
+        if off_since is None:
+            # Motion again, since the timeout expired
+            return
+        no_motion = monotonic() - off_since
+        if no_motion < room.motion_light_timeout:
+            # Re-armed (motion & no motion again), or longer timeout, since
+            # the timeout expired
+            if not room.off_timer.pending:
+                TIMER.reschedule(room.off_timer,
+                                 off_since + room.motion_light_timeout)
+            return
+        # Deadline handled: not re-armed until the next 'off' edge of the PIR
+        room.pir_off_since = None
+        room.latency[LATENCY_OFF_DELAY].add(
+            max(0., no_motion - room.motion_light_timeout))
+        self._resync_if_gated()
+        if room.motion_lights_running and \
+                room.extra_condition and not room.media_player_active:
+            if self._lights_are_off(room, include_motion_lights=False):
+                self.log('TURNING_OFF MOTION_LIGHTS in {}, after {:.1f} s '
+                         'without motion (timeout={} s)'
+                         .format(room.name, no_motion,
+                                 room.motion_light_timeout), LOG_LEVEL)
+                self._mirror.turn_off(room.lights_motion, transition=1)
             else:
-                self.log('NO TURN_OFF MOTION_LIGHTS '
+                self.log('NO TURN_OFF MOTION_LIGHTS in {} '
                          '(other lights in the room are ON={})'
-                         .format([self.get_state(l)
-                                  for l in self._lights_check_off]), LOG_LEVEL)
-            self._motion_lights_running = False
+                         .format(room.name, self._mirror.group_states(
+                             room.group_check_off)), LOG_LEVEL)
+            room.motion_lights_running = False
@@ -15,17 +15,134 @@ master state updates in the slave instance, so it's a one-way information
 pipe, **only from slave to master**, and it's better (=quicker response) than
 the REST sensors because it doesn't depend of scan intervals.
 
+The states are posted through `master_transport.MasterTransport` (buffered,
+spooled on disk while the master is down, optionally batched as events), to
+one or more masters. The args are documented in the README.
+
 """
 import appdaemon.appapi as appapi
-import homeassistant.remote as remote
+from concurrent.futures import ThreadPoolExecutor
 import datetime as dt
-from dateutil.parser import parse
-from math import ceil
+import heapq
+from master_transport import (
+    MasterTransport, apply_batch_event, batch_ack_state, state_hash,
+    DEFAULT_BATCH_EVENT,
+    DEFAULT_BATCH_SIZE, DEFAULT_FLUSH_INTERVAL, DEFAULT_MAX_IN_FLIGHT,
+    DEFAULT_PROBE_INTERVAL, DEFAULT_REPLAY_RATE)
+import os
+import re
+from raw_sensors_engine import ENGINE
+import tempfile
+from threading import Lock
+from time import monotonic
 
 
 LOG_LEVEL = 'INFO'
 DEFAULT_SUFFIX = '_slave'
 DEFAULT_RAWBS_SECS_OFF = 10
+DEFAULT_HEARTBEAT_INTERVAL = 60
+DEFAULT_METRICS_SENSOR = 'sensor.slave_publisher_metrics'
+DEFAULT_METRICS_INTERVAL = 60
+REGEX_RULE_PREFIX = 're:'
+
+
+class EntityFilter(object):
+    """Include / exclude rules for entity ids, compiled in one regex each.
+
+    Rules are globs (`*` & `?` wildcards) or, with a `re:` prefix,
+    regular expressions; both must match the whole entity id."""
+
+    def __init__(self, include=None, exclude=None):
+        self._include = self._compile(include)
+        self._exclude = self._compile(exclude)
+
+    def __call__(self, entity_id):
+        if self._include is not None \
+                and self._include.match(entity_id) is None:
+            return False
+        return self._exclude is None \
+            or self._exclude.match(entity_id) is None
+
+    def __repr__(self):
+        return '<EntityFilter include={} exclude={}>'.format(
+            self._include.pattern if self._include is not None else None,
+            self._exclude.pattern if self._exclude is not None else None)
+
+    @staticmethod
+    def _compile(rules):
+        if not rules:
+            return None
+        if isinstance(rules, str):
+            rules = rules.split(',')
+        regexes = []
+        for rule in (r.strip() for r in rules):
+            if rule.startswith(REGEX_RULE_PREFIX):
+                regexes.append(rule[len(REGEX_RULE_PREFIX):])
+            elif rule:
+                regexes.append(re.escape(rule).replace(
+                    '\\*', '.*').replace('\\?', '.'))
+        if not regexes:
+            return None
+        return re.compile('(?:{})\\Z'.format(
+            '|'.join('(?:{})'.format(regex) for regex in regexes)))
+
+
+class AttributesProjection(object):
+    """Attribute keys to publish, by entity id or by domain.
+
+    Each rule is `{'include': keys}` (whitelist) or `{'exclude': keys}`
+    (blacklist); entities with no rule keep all their attributes."""
+
+    def __init__(self, rules=None):
+        self._rules = {}
+        for key, rule in (rules or {}).items():
+            if 'include' in rule:
+                self._rules[key] = (True, self._keys(rule['include']))
+            else:
+                self._rules[key] = (False, self._keys(rule.get('exclude')))
+        self._by_entity = {}
+
+    def __call__(self, entity_id, attributes):
+        try:
+            rule = self._by_entity[entity_id]
+        except KeyError:
+            rule = self._rules.get(
+                entity_id, self._rules.get(entity_id.split('.')[0]))
+            self._by_entity[entity_id] = rule
+        if rule is None or not attributes:
+            return attributes
+        include, keys = rule
+        return {key: value for key, value in attributes.items()
+                if (key in keys) == include}
+
+    @staticmethod
+    def _keys(keys):
+        if not keys:
+            return frozenset()
+        if isinstance(keys, str):
+            keys = keys.split(',')
+        return frozenset(key.strip() for key in keys)
+
+
+class MasterLink(object):
+    """One master HA where the states are published.
+
+    Each master has its own transport (buffer, workers, spool), so a slow
+    or unreachable master never holds back the others, and its own suffix,
+    entity filter, attributes projection and metrics sensor."""
+
+    def __init__(self, transport, suffix, entity_filter, projection,
+                 metrics_sensor):
+        self.transport = transport
+        self.suffix = suffix
+        self.filter = entity_filter
+        self.project = projection
+        self.metrics_sensor = metrics_sensor
+        self.metrics_last = (monotonic(), 0, 0)
+
+    def __repr__(self):
+        return '<MasterLink {} suffix={}>'.format(
+            self.transport.base_url, self.suffix)
 
 
 # noinspection PyClassHasNoInit
@@ -36,119 +153,316 @@ class SlavePublisher(appapi.AppDaemon):
     from one HASS instance (main) in Another (remote).
     Valid for binary_sensors and sensors."""
 
-    _hass_master_url = None
-    _hass_master_key = None
-    _hass_master_port = None
-    _master_ha_api = None
+    _masters = None
+    _targets = None
 
-    _sufix = None
-    _sensor_updates = None
+    _heartbeat_interval = None
+    _heartbeats = None
+    _next_heartbeat = None
+    _next_discovery = None
+    _ignored = None
 
     _raw_sensors = None
-    _raw_sensors_sufix = None
-    _raw_sensors_seconds_to_off = None
-    _raw_sensors_last_states = {}
-    _raw_sensors_attributes = {}
 
     def initialize(self):
         """AppDaemon required method for app init."""
 
-        self._hass_master_url = self.args.get('master_ha_url')
-        self._hass_master_key = self.args.get('master_ha_key', '')
-        self._hass_master_port = int(self.args.get('master_ha_port', '8123'))
-        self._sufix = self.args.get('slave_sufix', DEFAULT_SUFFIX)
-        self._master_ha_api = remote.API(
-            self._hass_master_url, self._hass_master_key,
-            port=self._hass_master_port)
+        self._heartbeat_interval = int(self.args.get(
+            'heartbeat_interval', DEFAULT_HEARTBEAT_INTERVAL))
+        masters_args = self.args.get('masters') or [{}]
+        self._masters = [self._make_master_link(master_args, i)
+                         for i, master_args in enumerate(masters_args)]
+
+        # Slave states snapshot
+        bs_states = self.get_state('binary_sensor')
 
         # Raw binary sensors
-        self._raw_sensors = self.args.get('raw_binary_sensors', None)
-        if self._raw_sensors is not None:
-            self._raw_sensors = self._raw_sensors.split(',')
-            self._raw_sensors_sufix = self.args.get('raw_binary_sensors_sufijo', '_raw')
-            # Persistencia en segundos de último valor hasta considerarlos 'off'
-            self._raw_sensors_seconds_to_off = int(self.args.get('raw_binary_sensors_time_off', DEFAULT_RAWBS_SECS_OFF))
-
-            # Handlers de cambio en raw binary_sensors:
-            l1, l2 = 'attributes', 'last_changed'
-            for s in self._raw_sensors:
-                self._raw_sensors_attributes[s] = (s.replace(self._raw_sensors_sufix, ''), self.get_state(s, l1))
-                self._raw_sensors_last_states[s] = [parse(self.get_state(s, l2)).replace(tzinfo=None), False]
-                self.listen_state(self._turn_on_raw_sensor_on_change, s)
-            self.log('seconds_to_off: {}'.format(self._raw_sensors_seconds_to_off))
-            self.log('attributes_sensors: {}'.format(self._raw_sensors_attributes))
-            self.log('last_changes: {}'.format(self._raw_sensors_last_states))
-            # [self.set_state(dev, state='off', attributes=attrs) for dev, attrs in .._raw_sensors_attributes.values()]
-            [remote.set_state(self._master_ha_api, dev + self._sufix, 'off', attributes=attrs)
-             for dev, attrs in self._raw_sensors_attributes.values()]
-            next_run = self.datetime() + dt.timedelta(seconds=self._raw_sensors_seconds_to_off)
-            self.run_every(self._turn_off_raw_sensor_if_not_updated, next_run, self._raw_sensors_seconds_to_off)
+        self._raw_sensors = ENGINE.register_from_args(
+            self, self.args, self._publish_raw_sensor_states,
+            seconds_to_off=DEFAULT_RAWBS_SECS_OFF, initial_off=True,
+            states=bs_states)
 
         # Publish slave states in master
-        bs_states = self.get_state('binary_sensor')
         if self._raw_sensors is not None:
             [bs_states.pop(raw) for raw in self._raw_sensors]
 
         s_states = self.get_state('sensor')
         sensors = dict(**s_states)
         sensors.update(bs_states)
-        now = self.datetime()
-        sensor_updates = {}
-        for entity_id, state_atts in sensors.items():
-            self.log('SENSOR: {}, ATTRS={}'.format(entity_id, state_atts))
-            remote.set_state(self._master_ha_api, entity_id + self._sufix,
-                             state_atts['state'],
-                             attributes=state_atts['attributes'])
-            self.listen_state(self._ch_state, entity_id,
-                              attributes=state_atts['attributes'])
-            sensor_updates.update({entity_id + self._sufix: now})
-        self._sensor_updates = sensor_updates
+        self._targets = {}
+        self._ignored = set(self._raw_sensors or ())
+        self._ignored.update(link.metrics_sensor for link in self._masters)
+        self._add_targets(sensors)
+        for link in self._masters:
+            self.log('Publishing {} entities (of {}) in {}, with {}'.format(
+                sum(link in links for links in self._targets.values()),
+                len(sensors), link, link.filter))
+        # Listen first, so no change is lost during the initial sync
+        next_due = monotonic() + self._heartbeat_interval
+        self._next_heartbeat = {}
+        for entity_id in self._targets:
+            self.listen_state(self._ch_state, entity_id)
+            self._next_heartbeat[entity_id] = next_due
+        self._initial_sync()
+        self._heartbeats = [(next_due, entity_id)
+                            for entity_id in self._next_heartbeat]
+        heapq.heapify(self._heartbeats)
+        self._next_discovery = next_due
         self.run_minutely(self._update_states, None)
+        metrics_interval = int(self.args.get(
+            'metrics_interval', DEFAULT_METRICS_INTERVAL))
+        if metrics_interval > 0:
+            self.run_every(
+                self._publish_metrics,
+                self.datetime() + dt.timedelta(seconds=metrics_interval),
+                metrics_interval)
         self.log('Transfer states from slave to master in {} COMPLETE'
-                 .format(self._master_ha_api))
+                 .format(self._masters))
+
+    def _make_master_link(self, master_args, index):
+        """Transport & config of one of the `masters` (the app args are
+        the defaults; with no `masters`, they define the only master)."""
+        def _arg(key, default=None):
+            return master_args.get(key, self.args.get(key, default))
+
+        spool_path = _arg('publish_spool_path', os.path.join(
+            tempfile.gettempdir(), '{}_spool.db'.format(self.name)))
+        metrics_sensor = _arg('metrics_sensor', DEFAULT_METRICS_SENSOR)
+        if index:
+            # Not shared with the first master
+            if spool_path and 'publish_spool_path' not in master_args:
+                spool_path = '{}.{}'.format(spool_path, index)
+            if 'metrics_sensor' not in master_args:
+                metrics_sensor = '{}_{}'.format(metrics_sensor, index + 1)
+        transport = MasterTransport(
+            _arg('master_ha_url'), _arg('master_ha_key', ''),
+            port=int(_arg('master_ha_port', '8123')),
+            max_in_flight=int(_arg(
+                'master_max_in_flight', DEFAULT_MAX_IN_FLIGHT)),
+            flush_interval=float(_arg(
+                'publish_flush_interval', DEFAULT_FLUSH_INTERVAL)),
+            spool_path=spool_path,
+            probe_interval=float(_arg(
+                'master_probe_interval', DEFAULT_PROBE_INTERVAL)),
+            replay_rate=float(_arg(
+                'publish_replay_rate', DEFAULT_REPLAY_RATE)),
+            batch_event=_arg('publish_batch_event'),
+            batch_size=int(_arg('publish_batch_size', DEFAULT_BATCH_SIZE)),
+            batch_ack_entity=_arg('publish_batch_ack_entity'),
+            log=self.log)
+        return MasterLink(
+            transport, _arg('slave_sufix', DEFAULT_SUFFIX),
+            EntityFilter(_arg('publish_include'), _arg('publish_exclude')),
+            AttributesProjection(_arg('publish_attributes')),
+            metrics_sensor)
+
+    def _add_targets(self, entity_ids):
+        """Add the entities published in some master to `_targets`,
+        and the others to `_ignored`; returns the new targets."""
+        new_targets = []
+        for entity_id in entity_ids:
+            if entity_id in self._ignored:
+                continue
+            links = tuple(link for link in self._masters
+                          if link.filter(entity_id))
+            if links:
+                self._targets[entity_id] = links
+                new_targets.append(entity_id)
+            else:
+                self._ignored.add(entity_id)
+        return new_targets
+
+    def _discover_entities(self, now):
+        """Listen to (and push) the entities created after the init.
+
+        Only the entity ids are compared; the filters are applied once
+        to each new entity id."""
+        entity_ids = set(self.get_state('sensor'))
+        entity_ids.update(self.get_state('binary_sensor'))
+        entity_ids.difference_update(self._targets)
+        new_targets = self._add_targets(entity_ids)
+        next_due = now + self._heartbeat_interval
+        for entity_id in new_targets:
+            self.listen_state(self._ch_state, entity_id)
+            self._next_heartbeat[entity_id] = next_due
+            heapq.heappush(self._heartbeats, (next_due, entity_id))
+            state_atts = self.get_state(entity_id, attribute='all')
+            if state_atts is not None:
+                for link in self._targets[entity_id]:
+                    link.transport.set_state(
+                        entity_id + link.suffix, state_atts['state'],
+                        link.project(entity_id, state_atts['attributes']))
+        if new_targets:
+            self.log('New entities published: {}'.format(new_targets))
+
+    def _initial_sync(self):
+        """Push to each master only the states it doesn't have yet.
+
+        The master states are read in one request per master (all of them
+        at once), and compared (by content hash) with the current slave
+        states; the differences go through the transport workers
+        (`master_max_in_flight` requests in flight per master)."""
+        with ThreadPoolExecutor(max_workers=len(self._masters)) as executor:
+            all_master_states = list(executor.map(
+                lambda link: link.transport.get_states(), self._masters))
+        local_states = self.get_state('sensor')
+        local_states.update(self.get_state('binary_sensor'))
+        for link, master_states in zip(self._masters, all_master_states):
+            if master_states is None:
+                master_hashes = {}
+                self.log('States of {} not available, pushing all'
+                         .format(link), 'WARNING')
+            else:
+                master_hashes = {
+                    s['entity_id']: state_hash(s['state'], s['attributes'])
+                    for s in master_states
+                    if s['entity_id'].endswith(link.suffix)}
+            pushed, unchanged = [], 0
+            for entity_id, links in self._targets.items():
+                state_atts = local_states.get(entity_id)
+                if link not in links or state_atts is None:
+                    continue
+                key = entity_id + link.suffix
+                attributes = link.project(entity_id, state_atts['attributes'])
+                content_hash = state_hash(state_atts['state'], attributes)
+                if master_hashes.get(key) == content_hash:
+                    link.transport.set_acked(key, content_hash)
+                    unchanged += 1
+                else:
+                    link.transport.set_state(key, state_atts['state'],
+                                             attributes)
+                    pushed.append(entity_id)
+            self.log('Initial sync of {}: {} states pushed, {} already there'
+                     .format(link, len(pushed), unchanged))
+            self.log('Pushed: {}'.format(pushed), 'DEBUG')
 
     # noinspection PyUnusedLocal
     def _update_states(self, kwargs):
-        """Update states in master if they are not changed."""
-        now = self.datetime()
-        s_states = self.get_state('sensor')
-        bs_states = self.get_state('binary_sensor')
-        sensors = dict(**s_states)
-        sensors.update(bs_states)
-        for entity_id, state_atts in sensors.items():
-            key = entity_id + self._sufix
-            if key not in self._sensor_updates \
-                    or (now - self._sensor_updates[key]).total_seconds() > 60:
-                remote.set_state(
-                    self._master_ha_api, key, state_atts['state'],
-                    attributes=state_atts['attributes'])
-                self._sensor_updates[key] = now
+        """Heartbeat of the states not changed in the last interval.
+
+        Only the due entities are read, and they are resent only to
+        the masters which haven't acknowledged the same content.
+        Once per heartbeat interval, new entities are looked for."""
+        now = monotonic()
+        if now >= self._next_discovery:
+            self._next_discovery = now + self._heartbeat_interval
+            self._discover_entities(now)
+        resent = []
+        while self._heartbeats and self._heartbeats[0][0] <= now:
+            _, entity_id = heapq.heappop(self._heartbeats)
+            due = self._next_heartbeat[entity_id]
+            if due <= now:
+                state_atts = self.get_state(entity_id, attribute='all')
+                if state_atts is not None:
+                    for link in self._targets[entity_id]:
+                        key = entity_id + link.suffix
+                        attributes = link.project(
+                            entity_id, state_atts['attributes'])
+                        if state_hash(state_atts['state'], attributes
+                                      ) != link.transport.acked_hash(key):
+                            link.transport.set_state(
+                                key, state_atts['state'], attributes)
+                            resent.append(key)
+                due = now + self._heartbeat_interval
+                self._next_heartbeat[entity_id] = due
+            # Changed after the heartbeat was set: push it forward
+            heapq.heappush(self._heartbeats, (due, entity_id))
+        if resent:
+            self.log('Heartbeat resend: {}'.format(resent))
+        for link in self._masters:
+            self.log('Publisher stats of {}: {}'.format(
+                link, link.transport.stats()), 'DEBUG')
 
     # noinspection PyUnusedLocal
-    def _ch_state(self, entity, attribute, old, new, kwargs):
-        remote.set_state(
-            self._master_ha_api, entity + self._sufix, new, **kwargs)
-        self._sensor_updates[entity + self._sufix] = self.datetime()
+    def _publish_metrics(self, kwargs):
+        """Set the publisher metrics of the last interval as local sensors
+        (one for each master)."""
+        now = monotonic()
+        for link in self._masters:
+            stats = link.transport.stats(reset_latency=True)
+            last, last_requests, last_bytes = link.metrics_last
+            link.metrics_last = (now, stats['requests'], stats['bytes_sent'])
+            elapsed = max(now - last, 1e-3)
+            attributes = {'friendly_name': 'Slave publisher',
+                          'unit_of_measurement': 'req/s',
+                          'icon': 'mdi:lan-connect',
+                          'master': link.transport.base_url,
+                          'bytes_per_sec': round(
+                              (stats['bytes_sent'] - last_bytes) / elapsed,
+                              1)}
+            for key, value in stats.pop('latency').items():
+                attributes['latency_' + key] = value
+            attributes.update(stats)
+            self.set_state(
+                link.metrics_sensor,
+                state=round((stats['requests'] - last_requests) / elapsed, 2),
+                attributes=attributes)
 
     # noinspection PyUnusedLocal
-    def _turn_on_raw_sensor_on_change(self, entity, attribute,
-                                      old, new, kwargs):
-        _, last_st = self._raw_sensors_last_states[entity]
-        self._raw_sensors_last_states[entity] = [self.datetime(), True]
-        if not last_st:
-            name, attrs = self._raw_sensors_attributes[entity]
-            remote.set_state(
-                self._master_ha_api, name + self._sufix, 'on',
-                attributes=attrs)
+    def _ch_state(self, entity, attribute, old, new, kwargs):
+        state_atts = self.get_state(entity, attribute='all')
+        attributes = state_atts['attributes'] if state_atts else {}
+        for link in self._targets[entity]:
+            link.transport.set_state(entity + link.suffix, new,
+                                     link.project(entity, attributes))
+        self._next_heartbeat[entity] = monotonic() + self._heartbeat_interval
+
+    def terminate(self):
+        """AppDaemon method called before app reload."""
+        ENGINE.unregister(self)
+        for link in self._masters or []:
+            link.transport.stop()
+
+    def _publish_raw_sensor_states(self, updates):
+        for name, state, attributes in updates:
+            for link in self._masters:
+                if link.filter(name):
+                    link.transport.set_state(
+                        name + link.suffix, state,
+                        link.project(name, attributes))
+
+
+# noinspection PyClassHasNoInit
+class SlaveStatesReceiver(appapi.AppDaemon):
+    """SlaveStatesReceiver.
+
+    AppDaemon Class for the master HASS instance, which sets the states
+    received in batches from `SlavePublisher` (`publish_batch_event`),
+    and confirms each batch in the ack entity of its sender."""
+
+    _event = None
+    _acks = None
+    _lock = None
+
+    def initialize(self):
+        """AppDaemon required method for app init."""
+        self._event = self.args.get('event', DEFAULT_BATCH_EVENT)
+        self._acks = {}
+        self._lock = Lock()
+        self.listen_event(self._receive_states, self._event)
+        self.log('Receiving slave states in "{}" events'.format(self._event))
 
     # noinspection PyUnusedLocal
-    def _turn_off_raw_sensor_if_not_updated(self, *kwargs):
-        now = self.datetime()
-        for s, (ts, st) in self._raw_sensors_last_states.copy().items():
-            if st and ceil((now - ts).total_seconds()
-                           ) >= self._raw_sensors_seconds_to_off:
-                name, attrs = self._raw_sensors_attributes[s]
-                self._raw_sensors_last_states[s] = [now, False]
-                remote.set_state(
-                    self._master_ha_api, name + self._sufix, 'off',
-                    attributes=attrs)
+    def _receive_states(self, event_name, data, kwargs):
+        num_states = apply_batch_event(data, self._set_state)
+        self.log('Received {} slave states'.format(num_states), 'DEBUG')
+        if data.get('ack'):
+            self._confirm_batch(data['ack'])
+
+    def _confirm_batch(self, ack):
+        # Last acks kept here: the states read from AppDaemon lag behind
+        entity_id = ack['entity_id']
+        with self._lock:
+            current = self._acks.get(entity_id)
+            if current is None:
+                current = self.get_state(entity_id, attribute='all')
+            state, attributes = batch_ack_state(ack, current)
+            self._acks[entity_id] = {'state': state, 'attributes': attributes}
+            self.set_state(entity_id, state=state, attributes=attributes)
+
+    def _set_state(self, entity_id, state, attributes):
+        if attributes is None:
+            # Unchanged attributes
+            self.set_state(entity_id, state=state)
+        else:
+            self.set_state(entity_id, state=state, attributes=attributes)
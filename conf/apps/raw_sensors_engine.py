@@ -0,0 +1,429 @@
+# -*- coding: utf-8 -*-
+"""
+Shared engine for raw binary sensors, used by AppDaemon Apps for Home Assistant
+
+Lógica común para generar binary_sensors que representan ON para cambio de estado en los últimos X segundos,
+OFF si el último cambio es más antiguo, a partir de otros binary_sensors "en bruto" (vibración, sonido, ...).
+
+Las apps registran sus sensores "en bruto" en el motor, junto a un 'sink' que publica el estado derivado
+(`set_state` local, `remote.set_state` en un HA maestro, ...). El motor mantiene un único listener por entidad
+en bruto y un único timer para todos los apagados, y reparte cada transición a todas las apps suscritas:
+
+    ENGINE.register(self, 'binary_sensor.my_sensor_raw', self._publish_raw_sensor_states,
+                    suffix='_raw', seconds_to_off=5)
+    # "binary_sensor.my_sensor_raw" + sufijo "_raw"
+    #   ---> self._publish_raw_sensor_states([("binary_sensor.my_sensor", "on", attributes), ...])
+
+o, con la configuración estándar de las apps (`raw_binary_sensors`, `raw_binary_sensors_sufijo`,
+`raw_binary_sensors_time_off`, `raw_binary_sensors_coalesce_sec` y `raw_binary_sensors_min_interval_sec`):
+
+    ENGINE.register_from_args(self, self.args, self._publish_raw_sensor_states, initial_off=True)
+
+El listener compartido de cada entidad en bruto se registra a través de una de las apps suscritas, y AppDaemon
+aplica las restricciones (`constrain_*`) de esa app a todas sus llamadas, así que sólo las apps sin restricciones
+comparten listeners: las apps con restricciones tienen sus propios listeners (que sus restricciones filtran, como
+antes del motor común).
+
+La primera transición se publica en el acto, y las que llegan durante la ventana corta siguiente (`coalesce_sec`)
+se agrupan: los cambios on -> off -> on de un mismo sensor se colapsan al valor final (y se descartan si éste ya
+estaba publicado), y cada sink recibe un único lote con todas las transiciones pendientes. Un sink que falla no
+afecta a los demás, y sus transiciones no se marcan como publicadas.
+
+Los sensores "en bruto" baratos pueden oscilar a decenas de Hz: con el sensor derivado en 'on', los cambios que
+llegan antes de `min_interval_sec` desde el último aceptado se descartan en O(1), sin timers ni logs. Los contadores
+de cambios aceptados / descartados se publican como atributos del sensor derivado (`raw_edges_accepted`,
+`raw_edges_dropped`), para poder ajustar ese intervalo con datos reales.
+
+Los apagados y los envíos agrupados se programan con el timer de alta resolución de `hires_timer` (no con el
+scheduler de AppDaemon, que va a saltos de 1 s), así que un sensor derivado se apaga a las pocas decenas de ms
+de cumplirse su plazo, y no hay que redondear los segundos transcurridos. Ese timer sólo prepara los lotes: los
+sinks (que hacen llamadas HTTP) se ejecutan en un hilo propio de cada app, en orden, así que un sink lento no
+retrasa los plazos de los demás sensores ni los de otras apps que usen `hires_timer`.
+
+"""
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+import datetime as dt
+from ha_datetime import parse_ha_datetime
+import heapq
+from hires_timer import TIMER
+from threading import Lock
+from time import monotonic
+import traceback
+
+
+DEFAULT_SUFFIX = '_raw'
+DEFAULT_RAWBS_SECS_OFF = 10
+DEFAULT_COALESCE_SEC = .25
+DEFAULT_MIN_INTERVAL_SEC = .2
+ATTR_EDGES_ACCEPTED = 'raw_edges_accepted'
+ATTR_EDGES_DROPPED = 'raw_edges_dropped'
+
+# Last published state of a derived sensor
+PUBLISHED_OFF = 0
+PUBLISHED_ON = 1
+PUBLISHED_UNKNOWN = 2
+
+
+def _monotonic_from_last_changed(last_changed, now_mono, now_utc):
+    """Translate the HA `last_changed` str of a raw sensor to the monotonic clock."""
+    ts = parse_ha_datetime(last_changed)
+    if ts is None:
+        return now_mono
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=dt.timezone.utc)
+    return now_mono - max(0., (now_utc - ts).total_seconds())
+
+
+class RawSensorsStore(object):
+    """Compact state store for the derived raw sensors.
+
+    Each subscription (one app, one raw sensor) lives in a slot of parallel arrays: float monotonic timestamps of
+    the last change (last accepted raw edge), float persistence times and minimum intervals between raw edges,
+    packed on/off flags, last published & last queued states, counters of accepted / dropped raw edges, plus plain lists
+    for the static data.
+    The entity -> slots map is precomputed on registration, so updating a state does not allocate anything."""
+
+    def __init__(self):
+        self.last_change = array('d')
+        self.delta_off = array('d')
+        self.min_interval = array('d')
+        self.edges_accepted = array('Q')
+        self.edges_dropped = array('Q')
+        self.is_on = bytearray()
+        self.published = bytearray()
+        self.queued = bytearray()
+        self.names = []
+        self.attributes = []
+        self.sinks = []
+        self.app_names = []
+        self.slots = {}
+        self._free = []
+
+    def __len__(self):
+        return len(self.names) - len(self._free)
+
+    def add(self, app_name, raw, name, attributes, sink, delta_off, last_change, min_interval=0.):
+        """Store a new subscription and return its slot."""
+        if self._free:
+            slot = self._free.pop()
+            self.last_change[slot] = last_change
+            self.delta_off[slot] = delta_off
+            self.min_interval[slot] = min_interval
+            self.edges_accepted[slot] = self.edges_dropped[slot] = 0
+            self.is_on[slot] = 0
+            self.published[slot] = self.queued[slot] = PUBLISHED_UNKNOWN
+            self.names[slot] = name
+            self.attributes[slot] = attributes
+            self.sinks[slot] = sink
+            self.app_names[slot] = app_name
+        else:
+            slot = len(self.names)
+            self.last_change.append(last_change)
+            self.delta_off.append(delta_off)
+            self.min_interval.append(min_interval)
+            self.edges_accepted.append(0)
+            self.edges_dropped.append(0)
+            self.is_on.append(0)
+            self.published.append(PUBLISHED_UNKNOWN)
+            self.queued.append(PUBLISHED_UNKNOWN)
+            self.names.append(name)
+            self.attributes.append(attributes)
+            self.sinks.append(sink)
+            self.app_names.append(app_name)
+        self.slots[raw] = self.slots.get(raw, ()) + (slot,)
+        return slot
+
+    def published_attributes(self, slot):
+        """Attributes of the derived sensor, with the raw edges counters."""
+        attributes = dict(self.attributes[slot] or {})
+        attributes[ATTR_EDGES_ACCEPTED] = self.edges_accepted[slot]
+        attributes[ATTR_EDGES_DROPPED] = self.edges_dropped[slot]
+        return attributes
+
+    def remove_app(self, app_name):
+        """Free the slots of an app; return the raw entities without subscriptions."""
+        orphans = []
+        for raw, slots in list(self.slots.items()):
+            keep = tuple(slot for slot in slots if self.app_names[slot] != app_name)
+            for slot in slots:
+                if self.app_names[slot] == app_name:
+                    self.is_on[slot] = 0
+                    self.names[slot] = self.attributes[slot] = self.sinks[slot] = self.app_names[slot] = None
+                    self._free.append(slot)
+            if keep:
+                self.slots[raw] = keep
+            else:
+                self.slots.pop(raw)
+                orphans.append(raw)
+        return orphans
+
+
+class RawSensorsEngine(object):
+    """Raw binary sensors engine.
+
+    One state listener per raw entity and one turn off timer (for the nearest deadline in a min-heap) for all the
+    registered apps, whatever the number of apps watching the same raw sensor."""
+
+    @staticmethod
+    def _constraints(app):
+        return sorted(arg for arg in (app.args or {}) if arg.startswith('constrain_'))
+
+    def __init__(self):
+        self._lock = Lock()
+        self._apps = {}
+        self._coalesce = {}
+        self._executors = {}
+        self._store = RawSensorsStore()
+        self._listeners = {}
+        self._private_listeners = {}
+        self._deadlines = []
+        self._timer_turn_off = None
+        self._pending = {}
+        self._timer_flush = None
+
+    def _log(self, msg, level='INFO'):
+        """Log through one of the registered apps (the engine timers are shared by all of them)."""
+        for app in list(self._apps.values()):
+            app.log(msg, level)
+            break
+        else:
+            print(msg)
+
+    def register(self, app, raw_sensors, sink, suffix=DEFAULT_SUFFIX,
+                 seconds_to_off=DEFAULT_RAWBS_SECS_OFF, initial_off=False, coalesce_sec=DEFAULT_COALESCE_SEC,
+                 min_interval_sec=DEFAULT_MIN_INTERVAL_SEC, states=None):
+        """Register raw binary sensors for an app.
+
+        :param app: AppDaemon app, used for the state listeners (shared with the other apps, unless it has
+                    `constrain_*` args: then it gets its own listeners, gated by its constraints)
+        :param raw_sensors: list (or comma separated str) of raw binary_sensors
+        :param sink: callable as `sink(updates)` to publish lists of `(name, state, attributes)` derived states
+        :param suffix: suffix to remove from the raw entity to name the derived sensor
+        :param seconds_to_off: persistence (in seconds) of the 'on' state without raw changes
+        :param initial_off: publish the derived sensors as 'off' on registration
+        :param coalesce_sec: window (in seconds) for grouping the state writes (the engine uses the smallest one)
+        :param min_interval_sec: raw edges closer than this to the last accepted one are dropped (0 to disable)
+        :param states: optional snapshot of states (`get_state('binary_sensor')`) already taken by the app
+        """
+        if isinstance(raw_sensors, str):
+            raw_sensors = [s for s in raw_sensors.split(',') if s]
+        # On app re-init, subscriptions of the old instance are replaced
+        self.unregister(app)
+
+        # One states snapshot per domain instead of 2 reads per raw sensor
+        states = dict(states or {})
+        for domain in set(raw.split('.')[0] for raw in raw_sensors if raw not in states):
+            states.update(app.get_state(domain) or {})
+
+        store = self._store
+        new_slots = []
+        with self._lock:
+            self._apps[app.name] = app
+            self._coalesce[app.name] = float(coalesce_sec)
+            # Sink calls of the app, in order, out of the timer & AppDaemon threads
+            self._executors[app.name] = ThreadPoolExecutor(max_workers=1)
+            # Its constraints would gate the raw events of every app sharing its listeners
+            private = bool(self._constraints(app))
+            if private:
+                self._private_listeners[app.name] = []
+            now, now_utc = monotonic(), dt.datetime.now(tz=dt.timezone.utc)
+            for raw in raw_sensors:
+                raw_state = states.get(raw) or {}
+                last_change = _monotonic_from_last_changed(raw_state.get('last_changed'), now, now_utc)
+                new_slots.append(store.add(app.name, raw, raw.replace(suffix, ''), raw_state.get('attributes'),
+                                           sink, float(seconds_to_off), last_change, float(min_interval_sec)))
+                if private:
+                    self._private_listeners[app.name].append(
+                        app.listen_state(self._raw_sensor_changed, raw, engine_app=app.name))
+                elif raw not in self._listeners:
+                    self._listeners[raw] = (app.name, app.listen_state(self._raw_sensor_changed, raw))
+            derived = [(store.names[slot], 'off', store.published_attributes(slot)) for slot in new_slots]
+            if initial_off:
+                for slot in new_slots:
+                    store.published[slot] = store.queued[slot] = PUBLISHED_OFF
+        if initial_off and derived:
+            sink(derived)
+        return [name for name, _, _ in derived]
+
+    def register_from_args(self, app, args, sink, seconds_to_off=DEFAULT_RAWBS_SECS_OFF, initial_off=False,
+                           states=None):
+        """Register the raw binary sensors configured in the app args.
+
+        `raw_binary_sensors` (comma separated), `raw_binary_sensors_sufijo`, `raw_binary_sensors_time_off`
+        (`seconds_to_off` by default), `raw_binary_sensors_coalesce_sec` & `raw_binary_sensors_min_interval_sec`.
+        Returns the list of raw sensors (None if there is no `raw_binary_sensors` arg)."""
+        raw_sensors = args.get('raw_binary_sensors')
+        if raw_sensors is None:
+            return None
+        raw_sensors = [s for s in raw_sensors.split(',') if s]
+        seconds_to_off = float(args.get('raw_binary_sensors_time_off', seconds_to_off))
+        derived = self.register(
+            app, raw_sensors, sink, suffix=args.get('raw_binary_sensors_sufijo', DEFAULT_SUFFIX),
+            seconds_to_off=seconds_to_off, initial_off=initial_off,
+            coalesce_sec=float(args.get('raw_binary_sensors_coalesce_sec', DEFAULT_COALESCE_SEC)),
+            min_interval_sec=float(args.get('raw_binary_sensors_min_interval_sec', DEFAULT_MIN_INTERVAL_SEC)),
+            states=states)
+        app.log('Raw sensors with seconds_to_off={}, derived_sensors: {}'.format(seconds_to_off, derived))
+        return raw_sensors
+
+    def unregister(self, app):
+        """Remove all the raw sensor subscriptions of an app (call it from `terminate`)."""
+        with self._lock:
+            if self._apps.pop(app.name, None) is None:
+                return
+            self._coalesce.pop(app.name)
+            self._executors.pop(app.name).shutdown(wait=False)
+            store = self._store
+            store.remove_app(app.name)
+            self._deadlines = [item for item in self._deadlines if store.app_names[item[1]] is not None]
+            heapq.heapify(self._deadlines)
+            self._pending = {slot: state for slot, state in self._pending.items() if store.app_names[slot] is not None}
+
+            for handle in self._private_listeners.pop(app.name, ()):
+                self._cancel(app.cancel_listen_state, handle)
+
+            # Move the listeners owned by the old app to another registered app (without constraints)
+            for raw, (owner, handle) in list(self._listeners.items()):
+                if owner != app.name:
+                    continue
+                self._cancel(app.cancel_listen_state, handle)
+                shared = [store.app_names[slot] for slot in store.slots.get(raw, ())
+                          if store.app_names[slot] not in self._private_listeners]
+                if shared:
+                    new_owner = self._apps[shared[0]]
+                    self._listeners[raw] = (new_owner.name, new_owner.listen_state(self._raw_sensor_changed, raw))
+                else:
+                    self._listeners.pop(raw)
+
+    @staticmethod
+    def _cancel(cancel_method, handle):
+        try:
+            cancel_method(handle)
+        except Exception:
+            # The handle was already removed by AppDaemon with the app
+            pass
+
+    def _queue_state(self, slot, state):
+        """Add a derived state transition to the pending batch (with lock); return True to flush it now.
+
+        The first transition is flushed now (leading edge), and opens the coalescing window for the next ones."""
+        self._pending[slot] = state
+        if self._timer_flush is not None and self._timer_flush.pending:
+            return False
+        window = min(self._coalesce.values()) if self._coalesce else 0
+        if window > 0:
+            if self._timer_flush is None:
+                self._timer_flush = TIMER.call_later(window, self._flush_pending_states, log=self._log)
+            else:
+                TIMER.reschedule(self._timer_flush, monotonic() + window)
+        return True
+
+    def _flush_pending_states(self):
+        """Queue the pending transitions, as one batch per sink, skipping the ones already queued.
+
+        The sinks are called in the thread of each app (`_publish_batch`), so this never blocks its caller."""
+        store = self._store
+        batches = {}
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            for slot, state in pending.items():
+                sink = store.sinks[slot]
+                code = PUBLISHED_ON if state == 'on' else PUBLISHED_OFF
+                if sink is None or store.queued[slot] == code:
+                    # Unregistered or collapsed flip (on -> off -> on)
+                    continue
+                store.queued[slot] = code
+                batches.setdefault(store.app_names[slot], (sink, []))[1].append(
+                    (slot, code, (store.names[slot], state, store.published_attributes(slot))))
+            for app_name, (sink, items) in batches.items():
+                self._executors[app_name].submit(self._publish_batch, self._apps[app_name], sink, items)
+
+    def _publish_batch(self, app, sink, items):
+        """Call a sink (in the thread of its app); its transitions are marked as published only if it succeeds."""
+        store = self._store
+        try:
+            sink([update for _, _, update in items])
+            ok = True
+        except Exception:
+            app.log('Error publishing raw sensors states with {}:\n{}'
+                    .format(sink, traceback.format_exc()), 'ERROR')
+            ok = False
+        with self._lock:
+            for slot, code, _ in items:
+                if store.sinks[slot] != sink:
+                    continue
+                if ok:
+                    store.published[slot] = code
+                elif store.queued[slot] == code:
+                    # Not published: the next transitions of these sensors are compared with the old states
+                    store.queued[slot] = store.published[slot]
+
+    def _schedule_turn_off(self):
+        """Program the turn off timer for the nearest deadline (with lock)."""
+        if not self._deadlines:
+            return
+        nearest = self._deadlines[0][0]
+        if self._timer_turn_off is None:
+            self._timer_turn_off = TIMER.call_at(nearest, self._turn_off_raw_sensors_if_not_updated,
+                                                 log=self._log)
+        elif not self._timer_turn_off.pending or self._timer_turn_off.deadline > nearest:
+            TIMER.reschedule(self._timer_turn_off, nearest)
+
+    # noinspection PyUnusedLocal
+    def _raw_sensor_changed(self, entity, attribute, old, new, kwargs):
+        store = self._store
+        flush = turn_on = False
+        # Own listener of an app with constraints, or the shared one (for the other apps)
+        listener_app = kwargs.get('engine_app')
+        with self._lock:
+            now = monotonic()
+            for slot in store.slots.get(entity, ()):
+                if listener_app is None:
+                    if store.app_names[slot] in self._private_listeners:
+                        continue
+                elif store.app_names[slot] != listener_app:
+                    continue
+                if store.is_on[slot] and now - store.last_change[slot] < store.min_interval[slot]:
+                    # Chattering sensor: the deadline is refreshed by the next accepted edge
+                    store.edges_dropped[slot] += 1
+                    continue
+                store.edges_accepted[slot] += 1
+                store.last_change[slot] = now
+                if not store.is_on[slot]:
+                    # Only one deadline per 'on' sensor; refreshes are checked
+                    # against the last change when the deadline expires.
+                    store.is_on[slot] = 1
+                    heapq.heappush(self._deadlines, (now + store.delta_off[slot], slot))
+                    flush = self._queue_state(slot, 'on') or flush
+                    turn_on = True
+            if turn_on:
+                self._schedule_turn_off()
+        if flush:
+            self._flush_pending_states()
+
+    def _turn_off_raw_sensors_if_not_updated(self):
+        store = self._store
+        flush = False
+        with self._lock:
+            now = monotonic()
+            while self._deadlines and self._deadlines[0][0] <= now:
+                _, slot = heapq.heappop(self._deadlines)
+                if not store.is_on[slot]:
+                    continue
+                deadline = store.last_change[slot] + store.delta_off[slot]
+                if deadline > now:
+                    # Updated after the deadline was set: push it forward
+                    heapq.heappush(self._deadlines, (deadline, slot))
+                else:
+                    store.is_on[slot] = 0
+                    store.last_change[slot] = now
+                    # Expired sensors are already a batch: flush it now, without the coalescing delay
+                    self._pending[slot] = 'off'
+                    flush = True
+            self._schedule_turn_off()
+        if flush:
+            self._flush_pending_states()
+
+
+ENGINE = RawSensorsEngine()
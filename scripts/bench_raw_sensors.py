@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic benchmark for the raw binary sensors apps.
+
+Runs `RawBinarySensors`, `PublisherRawSensors` and the raw sensors part of `MotionAlarm` against an in-process fake
+of `appdaemon.appapi.AppDaemon` (no HA, no AppDaemon, no network), driving a population of raw sensors with random
+state changes, and reports:
+
+- callbacks/sec (state callbacks dispatched by the fake AppDaemon)
+- p50 / p99 latency of the state handlers
+- `set_state` calls emitted (local or to the remote master)
+- peak RSS of the scenario (each scenario runs in its own process)
+
+    python scripts/bench_raw_sensors.py --apps raw,publisher,alarm --sensors 10,100,1000,10000 --rate 0 --duration 5
+
+`--rate 0` drives the handlers as fast as possible; `--rate N` paces the events at N events/sec.
+
+"""
+import argparse
+import datetime as dt
+import multiprocessing as mp
+import os
+import random
+import resource
+import sys
+import time
+import types
+
+
+PATH_APPS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'conf', 'apps')
+APPS = {
+    'raw': ('raw_bin_sensors', 'RawBinarySensors'),
+    'publisher': ('binary_changing_sensors', 'PublisherRawSensors'),
+    'alarm': ('motion_alarm_push_email', 'MotionAlarm'),
+}
+SET_STATE_CALLS = [0]
+
+
+class FakeAppDaemon(object):
+    """In-process stand-in for `appdaemon.appapi.AppDaemon` (the parts used by the raw sensors apps)."""
+
+    bench_states = {}
+    bench_listeners = {}
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.config = {'AppDaemon': {}}
+
+    def log(self, msg, level='INFO'):
+        pass
+
+    def error(self, msg, level='ERROR'):
+        pass
+
+    def datetime(self):
+        return dt.datetime.now()
+
+    def get_state(self, entity_id=None, attribute=None):
+        if entity_id is None:
+            return dict(self.bench_states)
+        if '.' not in entity_id:
+            return {k: v for k, v in self.bench_states.items() if k.startswith(entity_id + '.')}
+        state = self.bench_states.get(entity_id)
+        if state is None:
+            return None
+        if attribute is None:
+            return state['state']
+        if attribute == 'all':
+            return state
+        if attribute in state:
+            return state[attribute]
+        return state['attributes'].get(attribute)
+
+    def set_state(self, entity_id, state=None, attributes=None):
+        SET_STATE_CALLS[0] += 1
+
+    def listen_state(self, callback, entity=None, **kwargs):
+        self.bench_listeners.setdefault(entity, []).append(callback)
+        return callback, entity
+
+    def cancel_listen_state(self, handle):
+        callback, entity = handle
+        self.bench_listeners[entity].remove(callback)
+
+    def run_in(self, callback, seconds, **kwargs):
+        pass
+
+    def run_every(self, callback, start, interval, **kwargs):
+        pass
+
+    def run_minutely(self, callback, start, **kwargs):
+        pass
+
+    def cancel_timer(self, handle):
+        pass
+
+    def listen_event(self, callback, event=None, **kwargs):
+        pass
+
+    def call_service(self, service, **kwargs):
+        pass
+
+
+def _install_fakes():
+    """Put the fake AppDaemon (and HA remote API) modules in place of the real ones."""
+    appdaemon = types.ModuleType('appdaemon')
+    appapi = types.ModuleType('appdaemon.appapi')
+    appapi.AppDaemon = FakeAppDaemon
+    conf = types.ModuleType('appdaemon.conf')
+    conf.callbacks_lock = None
+    conf.tz = dt.timezone.utc
+    appdaemon.appapi, appdaemon.conf = appapi, conf
+
+    homeassistant = types.ModuleType('homeassistant')
+    remote = types.ModuleType('homeassistant.remote')
+    remote.API = lambda *args, **kwargs: None
+
+    def _remote_set_state(api, entity_id, new_state, attributes=None, force_update=False):
+        SET_STATE_CALLS[0] += 1
+    remote.set_state = _remote_set_state
+    homeassistant.remote = remote
+
+    sys.modules.update({'appdaemon': appdaemon, 'appdaemon.appapi': appapi, 'appdaemon.conf': conf,
+                        'homeassistant': homeassistant, 'homeassistant.remote': remote})
+    sys.path.insert(0, PATH_APPS)
+
+
+def _make_app(app_key, raw_sensors, opts):
+    module_name, class_name = APPS[app_key]
+    module = __import__(module_name)
+    args = {'raw_binary_sensors': ','.join(raw_sensors),
+            'raw_binary_sensors_sufijo': '_raw',
+            'raw_binary_sensors_time_off': opts.time_off,
+            'raw_binary_sensors_coalesce_sec': opts.coalesce,
+            'raw_binary_sensors_min_interval_sec': opts.min_interval}
+    app = getattr(module, class_name)(app_key, args)
+    if app_key == 'alarm':
+        # Only the raw sensors part of the alarm
+        app._raw_sensors = args['raw_binary_sensors']
+        app._init_raw_sensors()
+    else:
+        app.initialize()
+    return app
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100.))]
+
+
+def _run_scenario(app_keys, num_sensors, opts, results):
+    _install_fakes()
+    last_changed = dt.datetime.now(tz=dt.timezone.utc).isoformat()
+    raw_sensors = ['binary_sensor.bench_{}_raw'.format(i) for i in range(num_sensors)]
+    FakeAppDaemon.bench_states = {
+        s: {'entity_id': s, 'state': 'off', 'last_changed': last_changed,
+            'attributes': {'friendly_name': s, 'device_class': 'vibration'}} for s in raw_sensors}
+    apps = [_make_app(key, raw_sensors, opts) for key in app_keys]
+    listeners = FakeAppDaemon.bench_listeners
+    SET_STATE_CALLS[0] = 0
+
+    rnd = random.Random(opts.seed)
+    latencies = []
+    num_callbacks = 0
+    period = 1. / opts.rate if opts.rate > 0 else 0.
+    tic = time.perf_counter()
+    end = tic + opts.duration
+    next_event = tic
+    now = tic
+    while now < end:
+        if period:
+            if now < next_event:
+                time.sleep(next_event - now)
+            next_event += period
+        entity = raw_sensors[rnd.randrange(num_sensors)]
+        old = FakeAppDaemon.bench_states[entity]['state']
+        new = 'on' if old == 'off' else 'off'
+        FakeAppDaemon.bench_states[entity]['state'] = new
+        for callback in listeners.get(entity, ()):
+            t_cb = time.perf_counter()
+            callback(entity, 'state', old, new, {})
+            now = time.perf_counter()
+            latencies.append(now - t_cb)
+            num_callbacks += 1
+        now = time.perf_counter()
+    took = now - tic
+
+    # Let the pending turn-off & coalesced writes finish
+    time.sleep(opts.time_off + opts.coalesce + .2)
+    latencies.sort()
+    results.put({'apps': '+'.join(app_keys), 'sensors': num_sensors, 'callbacks': num_callbacks,
+                 'cb_per_sec': num_callbacks / took if took else 0.,
+                 'p50_us': _percentile(latencies, 50) * 1e6, 'p99_us': _percentile(latencies, 99) * 1e6,
+                 'set_state': SET_STATE_CALLS[0],
+                 'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.})
+    del apps
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Synthetic benchmark of the raw binary sensors apps')
+    parser.add_argument('--apps', default='raw,publisher,alarm',
+                        help='comma separated apps ({}); "a+b" runs apps together'.format(', '.join(APPS)))
+    parser.add_argument('--sensors', default='10,100,1000,10000', help='comma separated populations')
+    parser.add_argument('--rate', type=float, default=0, help='events/sec (0 = as fast as possible)')
+    parser.add_argument('--duration', type=float, default=5., help='seconds of events per scenario')
+    parser.add_argument('--time-off', type=float, default=.5, help='raw_binary_sensors_time_off')
+    parser.add_argument('--coalesce', type=float, default=.25, help='raw_binary_sensors_coalesce_sec')
+    parser.add_argument('--min-interval', type=float, default=.2, help='raw_binary_sensors_min_interval_sec')
+    parser.add_argument('--seed', type=int, default=42)
+    opts = parser.parse_args()
+
+    ctx = mp.get_context('fork')
+    print('{:<22} | {:>7} | {:>10} | {:>10} | {:>9} | {:>9} | {:>9} | {:>8}'.format(
+        'apps', 'sensors', 'callbacks', 'cb/s', 'p50 µs', 'p99 µs', 'set_state', 'RSS MB'))
+    for apps in opts.apps.split(','):
+        app_keys = apps.split('+')
+        for num_sensors in [int(n) for n in opts.sensors.split(',')]:
+            results = ctx.Queue()
+            proc = ctx.Process(target=_run_scenario, args=(app_keys, num_sensors, opts, results))
+            proc.start()
+            proc.join()
+            if proc.exitcode:
+                print('{:<22} | {:>7} | FAILED (exit code {})'.format(apps, num_sensors, proc.exitcode))
+                continue
+            r = results.get()
+            print('{apps:<22} | {sensors:>7} | {callbacks:>10} | {cb_per_sec:>10.0f} | {p50_us:>9.1f} | '
+                  '{p99_us:>9.1f} | {set_state:>9} | {peak_rss_mb:>8.1f}'.format(**r))
+
+
+if __name__ == '__main__':
+    main()
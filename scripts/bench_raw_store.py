@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Memory & throughput comparison of the raw binary sensors state store.
+
+Legacy store: dict of `[datetime, bool]` lists, replaced on every raw event.
+New store: `raw_sensors_engine.RawSensorsStore`, parallel arrays indexed by slot. Its throughput is measured
+through the state handler of a `RawSensorsEngine` (`_raw_sensor_changed`), with the sensors registered by a fake
+app (no AppDaemon) and a sink which does nothing, so it includes the whole handler (lock, chattering filter,
+deadlines heap and coalesced publication), while the legacy column is only its dict update.
+
+    python scripts/bench_raw_store.py [num_sensors ...]
+
+"""
+import datetime as dt
+import os
+import random
+import sys
+from time import monotonic, perf_counter
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'conf', 'apps'))
+from raw_sensors_engine import RawSensorsEngine, RawSensorsStore  # noqa: E402
+
+
+NUM_EVENTS = 200000
+
+
+class FakeApp(object):
+    """The parts of an AppDaemon app used by `RawSensorsEngine.register`."""
+
+    def __init__(self, name, states):
+        self.name = name
+        self.args = {}
+        self._states = states
+
+    def log(self, msg, level='INFO'):
+        pass
+
+    def get_state(self, entity_id=None, attribute=None):
+        return {k: v for k, v in self._states.items() if k.startswith(entity_id + '.')}
+
+    def listen_state(self, callback, entity=None, **kwargs):
+        return entity
+
+    def cancel_listen_state(self, handle):
+        pass
+
+
+def _entities(num_sensors):
+    return ['binary_sensor.vibration_{}_raw'.format(i) for i in range(num_sensors)]
+
+
+def build_legacy(entities, attributes=None):
+    """Per sensor `[datetime, bool]` list (as after the first event) & `(name, attributes)` tuple."""
+    last_states = {s: [dt.datetime.now(), False] for s in entities}
+    names_attrs = {s: (s, attributes) for s in entities}
+    return last_states, names_attrs
+
+
+def build_store(entities, attributes=None):
+    """Same data in the slot store (names and attributes objects are shared in both cases)."""
+    store = RawSensorsStore()
+    now = monotonic()
+    for s in entities:
+        store.add('bench', s, s, attributes, None, 2., now)
+    return store
+
+
+def measure_memory(builder, entities):
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    obj = builder(entities)
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del obj
+    return after - before
+
+
+def run_legacy(last_states, events):
+    tic = perf_counter()
+    for entity in events:
+        _, last_st = last_states[entity]
+        last_states[entity] = [dt.datetime.now(), True]
+    return perf_counter() - tic
+
+
+def build_engine(entities):
+    """Engine with the sensors registered by a fake app (1 ms min interval, so most events are accepted)."""
+    last_changed = dt.datetime.now(tz=dt.timezone.utc).isoformat()
+    states = {s: {'entity_id': s, 'state': 'off', 'last_changed': last_changed, 'attributes': {}} for s in entities}
+    engine, app = RawSensorsEngine(), FakeApp('bench', states)
+    engine.register(app, entities, lambda updates: None, seconds_to_off=2., min_interval_sec=.001)
+    return engine, app
+
+
+def run_store(engine, events):
+    raw_sensor_changed, kwargs = engine._raw_sensor_changed, {}
+    tic = perf_counter()
+    for entity in events:
+        raw_sensor_changed(entity, 'state', 'off', 'on', kwargs)
+    return perf_counter() - tic
+
+
+def main(sizes):
+    print('{:>8} | {:>14} | {:>14} | {:>14} | {:>14}'.format(
+        'sensors', 'legacy mem KiB', 'store mem KiB', 'legacy ev/s', 'store ev/s'))
+    for num_sensors in sizes:
+        entities = _entities(num_sensors)
+        events = [random.choice(entities) for _ in range(NUM_EVENTS)]
+        mem_legacy = measure_memory(build_legacy, entities)
+        mem_store = measure_memory(build_store, entities)
+        took_legacy = run_legacy(build_legacy(entities)[0], events)
+        engine, app = build_engine(entities)
+        took_store = run_store(engine, events)
+        engine.unregister(app)
+        print('{:>8} | {:>14.1f} | {:>14.1f} | {:>14.0f} | {:>14.0f}'.format(
+            num_sensors, mem_legacy / 1024, mem_store / 1024,
+            NUM_EVENTS / took_legacy, NUM_EVENTS / took_store))
+
+
+if __name__ == '__main__':
+    main([int(x) for x in sys.argv[1:]] or [1000, 10000])
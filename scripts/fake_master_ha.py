@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Stand-in for the REST API of a master Home Assistant, for trying `SlavePublisher` / `MasterTransport` offline.
+
+Implements the endpoints used by the publisher (`GET /api/`, `GET|POST /api/states/<entity_id>`, `GET /api/states`,
+`POST /api/events/<event_type>`) over an in-memory state machine, and can simulate master outages: while 'down',
+every connection is dropped without answer, as a restarting HA (or a broken link) does.
+
+    python scripts/fake_master_ha.py --port 18123 --down-every 30 --down-for 10
+
+With `--receiver-event slave_states`, the batches of states posted as that event are applied to the states
+(and confirmed in their ack entity), as the `SlaveStatesReceiver` app does in the master.
+
+The downtime can also be toggled by hand (`curl -X POST http://localhost:18123/fake/down` and `/fake/up`),
+or from python:
+
+    master = FakeMasterHA(port=18123).start()
+    master.set_down(True)
+    ...
+    master.set_down(False)
+    print(master.states, master.num_posts)
+    master.stop()
+
+"""
+import argparse
+import datetime as dt
+import json
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import os
+from socketserver import ThreadingMixIn
+import sys
+from threading import Lock, Thread
+import time
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'conf', 'apps'))
+from master_transport import apply_batch_event, batch_ack_state  # noqa: E402
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    master = None
+
+    def log_message(self, fmt, *args):
+        if self.master.verbose:
+            BaseHTTPRequestHandler.log_message(self, fmt, *args)
+
+    def _reply(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length).decode() or 'null') if length else None
+
+    def _drop(self):
+        self.close_connection = True
+
+    def _check_auth(self):
+        if self.master.api_key and self.headers.get('X-HA-access') != self.master.api_key:
+            self._reply(401, {'message': '401: Unauthorized'})
+            return False
+        return True
+
+    def do_GET(self):
+        if self.master.down:
+            return self._drop()
+        if not self._check_auth():
+            return
+        if self.path == '/api/':
+            return self._reply(200, {'message': 'API running.'})
+        if self.path == '/api/states':
+            return self._reply(200, list(self.master.states.values()))
+        if self.path.startswith('/api/states/'):
+            state = self.master.states.get(self.path[len('/api/states/'):])
+            if state is None:
+                return self._reply(404, {'message': 'Entity not found'})
+            return self._reply(200, state)
+        self._reply(404, {'message': 'Not found'})
+
+    def do_POST(self):
+        if self.path in ('/fake/down', '/fake/up'):
+            self._read_json()
+            self.master.set_down(self.path == '/fake/down')
+            return self._reply(200, {'down': self.master.down})
+        if self.master.down:
+            return self._drop()
+        if not self._check_auth():
+            return
+        data = self._read_json()
+        if self.path.startswith('/api/states/'):
+            entity_id = self.path[len('/api/states/'):]
+            is_new = self.master.set_state(entity_id, data['state'], data.get('attributes') or {})
+            return self._reply(201 if is_new else 200, self.master.states[entity_id])
+        if self.path.startswith('/api/events/'):
+            event_type = self.path[len('/api/events/'):]
+            self.master.fire_event(event_type, data)
+            return self._reply(200, {'message': 'Event {} fired.'.format(event_type)})
+        self._reply(404, {'message': 'Not found'})
+
+
+class FakeMasterHA(object):
+    """In-memory HA REST API server, with simulated downtime."""
+
+    def __init__(self, host='127.0.0.1', port=18123, api_key='', receiver_event=None, verbose=False):
+        self.api_key = api_key
+        self.receiver_event = receiver_event
+        self.verbose = verbose
+        self.down = False
+        self.states = {}
+        self.events = []
+        self.num_posts = 0
+        self._lock = Lock()
+        self._ack_lock = Lock()
+        handler = type('Handler', (_Handler,), {'master': self})
+        self._server = _ThreadingHTTPServer((host, port), handler)
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(target=self._server.serve_forever, name='fake_master_ha', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def set_down(self, down):
+        self.down = down
+        print('{} MASTER {}'.format(dt.datetime.now().strftime('%H:%M:%S'), 'DOWN' if down else 'UP'))
+
+    def set_state(self, entity_id, state, attributes=None):
+        """Set a state as the HA state machine does; returns True if the entity is new."""
+        now = dt.datetime.now(tz=dt.timezone.utc).isoformat()
+        with self._lock:
+            self.num_posts += 1
+            old = self.states.get(entity_id)
+            if attributes is None and old is not None:
+                # State without attributes (batch event): keep them
+                attributes = old['attributes']
+            new = {'entity_id': entity_id, 'state': str(state), 'attributes': attributes or {},
+                   'last_changed': now, 'last_updated': now}
+            if old is not None and old['state'] == new['state']:
+                new['last_changed'] = old['last_changed']
+            self.states[entity_id] = new
+        return old is None
+
+    def fire_event(self, event_type, data):
+        with self._lock:
+            self.events.append((event_type, data))
+        if event_type == self.receiver_event:
+            apply_batch_event(data, self.set_state)
+            if data.get('ack'):
+                with self._ack_lock:
+                    ack = data['ack']
+                    state, attributes = batch_ack_state(ack, self.states.get(ack['entity_id']))
+                    self.set_state(ack['entity_id'], state, attributes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stand-in master HA REST API, with simulated downtime')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18123)
+    parser.add_argument('--api-key', default='')
+    parser.add_argument('--down-every', type=float, default=0, help='secs between outages (0 = no outages)')
+    parser.add_argument('--down-for', type=float, default=10, help='duration of each outage, in secs')
+    parser.add_argument('--receiver-event', default=None,
+                        help='apply the batches of states of this event type (as the SlaveStatesReceiver app)')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    opts = parser.parse_args()
+
+    master = FakeMasterHA(opts.host, opts.port, opts.api_key, opts.receiver_event, opts.verbose).start()
+    print('Fake master HA listening in http://{}:{}'.format(opts.host, opts.port))
+    try:
+        while True:
+            if opts.down_every > 0:
+                time.sleep(opts.down_every)
+                master.set_down(True)
+                time.sleep(opts.down_for)
+                master.set_down(False)
+                print('{} states, {} posts, {} events'.format(
+                    len(master.states), master.num_posts, len(master.events)))
+            else:
+                time.sleep(3600)
+    except KeyboardInterrupt:
+        master.stop()
+
+
+if __name__ == '__main__':
+    main()